@@ -1,59 +1,371 @@
+import argparse
 import os
 os.environ["OPENCV_VIDEOIO_MSMF_ENABLE_HW_TRANSFORMS"] = "0"  # Disable hardware transforms for OpenCV on Windows (less delay)
-from calibration import *
-from both_webcams import *
-from click_recognition import *
-from triangulation import *
-
-# Parses the calibration settings file
-parse_settings_file()
-# Captures frames from two cameras
-save_frames_two_cams('camera0', 'camera1', 'stereo_frames')
-
-images = sorted(glob.glob("stereo_frames/*"))
-
-# Separates images for camera0 and camera1 based on filenames
-images_camera0 = [img for img in images if "camera0" in os.path.basename(img)]
-images_camera1 = [img for img in images if "camera1" in os.path.basename(img)]
-
-# Calibrates each camera individually
-print("Calibrating camera 0...")
-mtx1, dist1, rmse1 = calibrate_camera(images_camera0)
-print("Calibrating camera 1...")
-mtx2, dist2, rmse2 = calibrate_camera(images_camera1)
-
-# Performs stereo calibration
-print("Performing stereo calibration...")
-R, T, stereo_rmse = stereo_calibrate(mtx1, dist1, mtx2, dist2, images_camera0, images_camera1)
-
-# Save results to a text file
-with open("calibration_results.txt", "w") as f:
-    f.write("===== Camera 0 Calibration =====\n")
-    f.write(f"RMSE: {rmse1}\n")
-    f.write(f"Camera Matrix:\n{mtx1}\n")
-    f.write(f"Distortion Coefficients:\n{dist1}\n\n")
-
-    f.write("===== Camera 1 Calibration =====\n")
-    f.write(f"RMSE: {rmse2}\n")
-    f.write(f"Camera Matrix:\n{mtx2}\n")
-    f.write(f"Distortion Coefficients:\n{dist2}\n\n")
-
-    f.write("===== Stereo Calibration =====\n")
-    f.write(f"Stereo Calibration RMSE: {stereo_rmse}\n")
-    f.write(f"Rotation Matrix (R):\n{R}\n")
-    f.write(f"Translation Vector (T):\n{T}\n")
-
-print("Calibration results saved to 'calibration_results.txt'.")
-
-# We are gonna take one photo of the environment in each camera to select points
-save_single_frame_two_cams('camera0', 'camera1', 'single_frames')
-
-# We take the previous photos and select points in them
-# IMPORTANT: The points should be chosen in the same order for both
-# Press ESC to exit after choosing the points
-points0 = click_recognize('.\single_frames\camera0_0.png')
-points1 = click_recognize('.\single_frames\camera1_0.png')
-
-# Makes the triangulation of the chosen points based on 'real life' arbitrary 3d coordinates
-# PS: The first points chosen will serve as origin
-points3d = triangulate(mtx1, mtx2, R, T, points0, points1, '.\single_frames')
\ No newline at end of file
+
+# Every stage imports the modules it uses when it runs: a stage only pays for its own dependencies, and the
+# detection workers spawned by calibration re-import this module without loading anything
+
+def load_settings():
+    """
+    Parses the calibration settings file and enables the instrumentation if requested.
+    """
+    from both_webcams import calibration_settings, parse_settings_file
+    import instrumentation
+
+    parse_settings_file()
+
+    # Per-stage timers and counters, printed at the end of the run
+    instrumentation.enable(calibration_settings['instrumentation'])
+    return calibration_settings
+
+def print_instrumentation(settings):
+    import instrumentation
+
+    if instrumentation.enabled:
+        instrumentation.print_summary()
+        if settings['instrumentation_output']:
+            instrumentation.export(settings['instrumentation_output'])
+
+def saved_calibration(settings):
+    """
+    Returns the saved calibration if it was made with the current rig settings, otherwise None.
+    """
+    from calibration import load_calibration, settings_hash
+
+    return load_calibration(settings['calibration_file'], settings_hash(settings))
+
+def required_calibration(settings):
+    calibration = saved_calibration(settings)
+    if calibration is None:
+        print(f"No calibration for the current settings in '{settings['calibration_file']}'. Run the calibrate stage first.")
+        quit()
+    return calibration
+
+def capture_stage(settings):
+    """
+    Captures the calibration frames of every camera.
+    """
+    from both_webcams import rig_cameras, save_frames_rig, save_frames_two_cams
+    import instrumentation
+
+    cameras = rig_cameras()
+    with instrumentation.timer('stage.capture'):
+        if len(cameras) > 2:
+            save_frames_rig(cameras, 'rig_frames')
+        else:
+            save_frames_two_cams('camera0', 'camera1', 'stereo_frames')
+
+def write_view_report(f, report):
+    """
+    Writes the reprojection error of every solved view of a camera, marking the outliers.
+    """
+    import numpy as np
+
+    f.write("Reprojection error of each view (RMS / worst corner, pixels):\n")
+    for frame, error, corners, outlier in zip(report['frames'], report['view_errors'], report['corner_errors'],
+                                              report['outlier_views']):
+        f.write(f"  Frame {frame}: {error:.4f} / {np.nanmax(corners):.4f}{'  (outlier)' if outlier else ''}\n")
+    f.write("\n")
+
+def calibrate_stage(settings):
+    """
+    Calibrates the cameras from the captured frames and saves the calibration.
+    """
+    from both_webcams import list_replay_frames, rig_cameras
+    from calibration import (calibrate_camera, calibrate_rig, save_calibration, settings_hash, stereo_calibrate,
+                             stereo_detections)
+    from rectification import get_rectification
+    import instrumentation
+
+    # Number of processes and engine used for checkerboard detection
+    detection_workers = settings.get('detection_workers')
+    detection_engine = settings.get('detection_engine', 'pyramid')
+
+    # Frame subset sizes and outlier rejection used by the solvers
+    mono_frames = settings.get('mono_calibration_frames')
+    stereo_frames = settings.get('stereo_solver_frames')
+    rejection_rounds = settings.get('outlier_rejection_rounds', 0)
+
+    cameras = rig_cameras()
+    if len(cameras) > 2:
+        # Rigs of more than two cameras: chained calibration into the first camera's frame
+        print("Calibrating the rig...")
+        images = [list_replay_frames('rig_frames', camera_name, settings['save_format']) for camera_name in cameras]
+        with instrumentation.timer('stage.calibrate_rig'):
+            calibration = calibrate_rig(images, detection_workers, detection_engine, mono_frames, stereo_frames,
+                                        rejection_rounds)
+        for camera_name, rmse, stereo_rmse in zip(cameras, calibration['rmse'], calibration['stereo_rmse']):
+            print(f"{camera_name}: RMSE {rmse}, chained stereo RMSE {stereo_rmse}")
+        calibration['settings_hash'] = settings_hash(settings)
+        save_calibration(settings['calibration_file'], calibration)
+        print(f"Calibration saved to '{settings['calibration_file']}'.")
+        return calibration
+
+    # Frames of each camera, in the format they were saved in (frame store or image files)
+    images_camera0 = list_replay_frames('stereo_frames', 'camera0', settings['save_format'])
+    images_camera1 = list_replay_frames('stereo_frames', 'camera1', settings['save_format'])
+
+    # Calibrates each camera individually
+    print("Calibrating camera 0...")
+    with instrumentation.timer('stage.calibrate_camera0'):
+        mtx1, dist1, rmse1, report1 = calibrate_camera(images_camera0, detection_workers, detection_engine, mono_frames,
+                                                       rejection_rounds, report=True)
+    print("Calibrating camera 1...")
+    with instrumentation.timer('stage.calibrate_camera1'):
+        mtx2, dist2, rmse2, report2 = calibrate_camera(images_camera1, detection_workers, detection_engine, mono_frames,
+                                                       rejection_rounds, report=True)
+
+    # Performs stereo calibration
+    print("Performing stereo calibration...")
+    with instrumentation.timer('stage.stereo_calibrate'):
+        R, T, stereo_rmse, E, F = stereo_calibrate(mtx1, dist1, mtx2, dist2, images_camera0, images_camera1, detection_workers, detection_engine,
+                                                   stereo_frames, rejection_rounds)
+
+    # Save results to a text file
+    with open("calibration_results.txt", "w") as f:
+        f.write("===== Camera 0 Calibration =====\n")
+        f.write(f"RMSE: {rmse1}\n")
+        f.write(f"Camera Matrix:\n{mtx1}\n")
+        f.write(f"Distortion Coefficients:\n{dist1}\n")
+        write_view_report(f, report1)
+
+        f.write("===== Camera 1 Calibration =====\n")
+        f.write(f"RMSE: {rmse2}\n")
+        f.write(f"Camera Matrix:\n{mtx2}\n")
+        f.write(f"Distortion Coefficients:\n{dist2}\n")
+        write_view_report(f, report2)
+
+        f.write("===== Stereo Calibration =====\n")
+        f.write(f"Stereo Calibration RMSE: {stereo_rmse}\n")
+        f.write(f"Rotation Matrix (R):\n{R}\n")
+        f.write(f"Translation Vector (T):\n{T}\n")
+
+    print("Calibration results saved to 'calibration_results.txt'.")
+
+    # Save the machine-readable calibration so the next runs can skip capture and calibration
+    # The detected corners are kept so later drift checks only need to detect their new pairs
+    corners1, corners2, image_size = stereo_detections(images_camera0, images_camera1, detection_workers, detection_engine)
+    calibration = {
+        'mtx1': mtx1, 'dist1': dist1, 'mtx2': mtx2, 'dist2': dist2,
+        'R': R, 'T': T, 'E': E, 'F': F,
+        'image_size': image_size,
+        'rmse1': rmse1, 'rmse2': rmse2, 'stereo_rmse': stereo_rmse,
+        'settings_hash': settings_hash(settings),
+        'corners1': corners1, 'corners2': corners2,
+    }
+    save_calibration(settings['calibration_file'], calibration)
+    print(f"Calibration saved to '{settings['calibration_file']}'.")
+
+    # Computes the undistortion/rectification remap tables once per calibration (cached on disk)
+    with instrumentation.timer('stage.rectification'):
+        get_rectification(settings['rectification_file'], mtx1, dist1, mtx2, dist2, R, T, image_size)
+    return calibration
+
+def drift_check_stage(settings, calibration):
+    """
+    Refines a saved stereo calibration with a few new pairs and reports how far it moved.
+    """
+    import time
+    from both_webcams import list_replay_frames, save_frames_two_cams
+    from calibration import recalibrate, save_calibration
+    import instrumentation
+
+    # Each check gets its own folder, the pairs of the previous checks are already in the calibration
+    drift_folder = time.strftime('drift_frames_%Y%m%d_%H%M%S')
+    with instrumentation.timer('stage.capture'):
+        save_frames_two_cams('camera0', 'camera1', drift_folder)
+    # The accumulated pairs are capped like a full calibration, so every check costs about the same
+    max_frames = max(settings.get('mono_calibration_frames') or 0, settings.get('stereo_solver_frames') or 0) or None
+    with instrumentation.timer('stage.recalibrate'):
+        calibration, drift = recalibrate(calibration, list_replay_frames(drift_folder, 'camera0', settings['save_format']),
+                                         list_replay_frames(drift_folder, 'camera1', settings['save_format']),
+                                         settings.get('detection_workers'), settings.get('detection_engine', 'pyramid'),
+                                         max_frames=max_frames)
+    print("Calibration drift:")
+    for key, value in drift.items():
+        print(f"  {key}: {value:.6g}")
+    save_calibration(settings['calibration_file'], calibration)
+    return calibration
+
+def single_frame_stage(settings):
+    """
+    Takes one photo of the environment with every camera (in 'single_frames').
+    """
+    from both_webcams import rig_cameras, save_single_frame_rig, save_single_frame_two_cams
+    import instrumentation
+
+    cameras = rig_cameras()
+    with instrumentation.timer('stage.single_frame'):
+        if len(cameras) > 2:
+            save_single_frame_rig(cameras, 'single_frames')
+        else:
+            save_single_frame_two_cams('camera0', 'camera1', 'single_frames')
+
+def select_stage(settings, calibration):
+    """
+    Selects corresponding points in the single frames and saves them to 'points_file'.
+
+    Returns:
+        points (numpy.ndarray): (C,N,2) pixel coordinates, NaN where a point was not selected in a camera.
+    """
+    import numpy as np
+    from both_webcams import rig_cameras
+    import instrumentation
+
+    cameras = rig_cameras()
+    if len(cameras) == 2 and settings['point_selection'] == 'auto':
+        # Features matched along the epipolar lines of the stored fundamental matrix
+        import cv2 as cv
+        from feature_matching import match_stereo
+
+        with instrumentation.timer('stage.matching'):
+            points0, points1 = match_stereo(cv.imread(os.path.join('single_frames', 'camera0_0.png')),
+                                            cv.imread(os.path.join('single_frames', 'camera1_0.png')),
+                                            calibration['F'], calibration['mtx1'], calibration['dist1'],
+                                            calibration['mtx2'], calibration['dist2'], settings['feature_detector'],
+                                            settings['max_features'], settings['epipolar_band'])
+        print(f"Matched {len(points0)} points.")
+        if len(points0) == 0:
+            print("No features matched along the epipolar lines: check the calibration, or use point_selection: click.")
+        points = np.array([points0, points1])
+    else:
+        from click_recognition import click_recognize
+
+        # We take the previous photos and select points in them
+        # IMPORTANT: The points should be chosen in the same order in every image
+        # Press S for a point hidden in an image (it is recorded as NaN and the point keeps its place in the order)
+        # Press ESC to exit after choosing the points
+        selections = [click_recognize(os.path.join('single_frames', camera_name + '_0.png')) for camera_name in cameras]
+        points = np.full((len(cameras), max(len(selection) for selection in selections), 2), np.nan)
+        for camera, selection in enumerate(selections):
+            points[camera, :len(selection)] = np.reshape(selection, (-1, 2))
+
+    np.savez(settings['points_file'], points=points)
+    return points
+
+def triangulate_stage(settings, calibration, points=None):
+    """
+    Triangulates the selected points (read from 'points_file' when not given).
+    """
+    import numpy as np
+    import instrumentation
+
+    if points is None:
+        if not os.path.exists(settings['points_file']):
+            print(f"No selected points in '{settings['points_file']}'. Run the select stage first.")
+            quit()
+        with np.load(settings['points_file']) as data:
+            points = data['points']
+
+    if 'mtx' in calibration:
+        # Multi-view triangulation from every camera that saw each point
+        from triangulation import triangulate_rig
+
+        with instrumentation.timer('stage.triangulation'):
+            points3d, errors = triangulate_rig(calibration['mtx'], calibration['R'], calibration['T'], points, calibration['dist'],
+                                               settings['refine_triangulation'], return_errors=True)
+        print("Triangulated points:")
+        print(points3d)
+        print("Reprojection error of each point (pixels):")
+        print(errors)
+        if np.any(errors > settings['outlier_pixels']):
+            print(f"Points above {settings['outlier_pixels']} pixels (check the selection):", np.flatnonzero(errors > settings['outlier_pixels']))
+        return points3d
+
+    from triangulation import triangulate
+
+    # Two cameras: only the points seen in both images (skipped or extra clicks are NaN) are triangulated
+    seen = ~np.isnan(points).any(axis=(0, 2))
+    if not seen.all():
+        print(f"Ignoring {np.count_nonzero(~seen)} points not selected in both images.")
+        points = points[:, seen]
+
+    # Makes the triangulation of the chosen points based on 'real life' arbitrary 3d coordinates
+    # PS: The first points chosen will serve as origin (automatically matched points stay in the first camera's frame)
+    # The selected pixels are undistorted before triangulation, then the points are refined and their reprojection errors printed
+    with instrumentation.timer('stage.triangulation'):
+        return triangulate(calibration['mtx1'], calibration['mtx2'], calibration['R'], calibration['T'], points[0], points[1],
+                           'single_frames', show=not settings['headless'], dist1=calibration['dist1'], dist2=calibration['dist2'],
+                           refine=settings['refine_triangulation'], outlier_pixels=settings['outlier_pixels'],
+                           shift_origin=settings['point_selection'] != 'auto')
+
+def dense_stage(settings, calibration):
+    """
+    Dense point cloud of the single frame pair, with the frame rate of each resolution.
+    """
+    import cv2 as cv
+    from dense_stereo import DenseStereo, measure_fps, save_point_cloud
+    from rectification import get_rectification
+    import instrumentation
+
+    with instrumentation.timer('stage.rectification'):
+        rectification = get_rectification(settings['rectification_file'], calibration['mtx1'], calibration['dist1'],
+                                          calibration['mtx2'], calibration['dist2'], calibration['R'], calibration['T'],
+                                          calibration['image_size'])
+
+    frame0 = cv.imread(os.path.join('single_frames', 'camera0_0.png'))
+    frame1 = cv.imread(os.path.join('single_frames', 'camera1_0.png'))
+    dense_options = {'num_disparities': settings['dense_num_disparities'],
+                     'block_size': settings['dense_block_size'],
+                     'workers': settings['dense_workers']}
+    with instrumentation.timer('stage.dense_fps'):
+        for level, size, fps, point_count in measure_fps(rectification, frame0, frame1, **dense_options):
+            print(f"Dense stereo level {level} ({size[0]}x{size[1]}): {fps:.1f} FPS, {point_count} points")
+
+    with instrumentation.timer('stage.dense_stereo'):
+        dense = DenseStereo(rectification, settings['dense_level'], **dense_options)
+        cloud, disparity = dense.process(frame0, frame1)
+        dense.close()
+        save_point_cloud(settings['dense_output'], cloud)
+    print(f"Point cloud of {len(cloud)} points saved to '{settings['dense_output']}'.")
+
+def pipeline(settings):
+    """
+    Full run: calibration (reused when the rig settings have not changed), single frame, then dense depth
+    or point selection and triangulation.
+    """
+    calibration = saved_calibration(settings) if settings['reuse_calibration'] else None
+    if calibration is not None:
+        print(f"Using the saved calibration '{settings['calibration_file']}'.")
+        if settings['drift_check'] and 'mtx' not in calibration:
+            calibration = drift_check_stage(settings, calibration)
+    else:
+        capture_stage(settings)
+        calibration = calibrate_stage(settings)
+
+    single_frame_stage(settings)
+    if settings['dense_stereo'] and 'mtx' not in calibration:
+        dense_stage(settings, calibration)
+    else:
+        triangulate_stage(settings, calibration, select_stage(settings, calibration))
+
+# The pipeline only runs in the main process: calibration spawns detection workers that re-import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stereo (or multi-camera) calibration and triangulation.')
+    parser.add_argument('stage', nargs='?', default='pipeline',
+                        choices=('pipeline', 'capture', 'calibrate', 'select', 'triangulate', 'dense'),
+                        help='stage to run (default: the full pipeline)')
+    parser.add_argument('--no-capture', action='store_true',
+                        help='select and dense: use the frames already in single_frames instead of taking new ones')
+    args = parser.parse_args()
+
+    settings = load_settings()
+    if args.stage == 'pipeline':
+        pipeline(settings)
+    elif args.stage == 'capture':
+        capture_stage(settings)
+    elif args.stage == 'calibrate':
+        calibrate_stage(settings)
+    elif args.stage == 'select':
+        calibration = required_calibration(settings)
+        if not args.no_capture:
+            single_frame_stage(settings)
+        select_stage(settings, calibration)
+    elif args.stage == 'triangulate':
+        triangulate_stage(settings, required_calibration(settings))
+    elif args.stage == 'dense':
+        calibration = required_calibration(settings)
+        if not args.no_capture:
+            single_frame_stage(settings)
+        dense_stage(settings, calibration)
+    print_instrumentation(settings)
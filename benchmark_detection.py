@@ -0,0 +1,68 @@
+import argparse
+import time
+import cv2 as cv
+import numpy as np
+from calibration import detection_engines, find_chessboard
+from synthetic_rig import board_texture, normalized_grid, random_board_pose, render_board
+
+def corner_error(corners, truth):
+    """
+    Mean distance between detected and ground truth corners (the detector may return them in reverse order).
+    """
+    corners = corners.reshape(-1, 2)
+    return min(np.linalg.norm(corners - truth, axis=1).mean(), np.linalg.norm(corners[::-1] - truth, axis=1).mean())
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the checkerboard detection engines on synthetic frames.')
+    parser.add_argument('--frames', type=int, default=30, help='number of frames with a board')
+    parser.add_argument('--empty', type=int, default=10, help='number of frames without a board')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--rows', type=int, default=4)
+    parser.add_argument('--columns', type=int, default=5)
+    parser.add_argument('--noise', type=float, default=2.0, help='standard deviation of the pixel noise')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    np.random.seed(args.seed)
+    size = (args.width, args.height)
+    K = np.array([[args.width * 0.8, 0, args.width / 2], [0, args.width * 0.8, args.height / 2], [0, 0, 1]])
+    dist = np.array([-0.1, 0.05, 0, 0, 0])
+
+    grid = normalized_grid(K, dist, size)
+    texture = board_texture(args.rows, args.columns)
+    frames = []
+    for _ in range(args.frames):
+        rvec, tvec = random_board_pose(K, size, args.rows, args.columns, rng=rng)
+        frames.append(render_board(K, dist, rvec, tvec, size, args.rows, args.columns, args.noise, grid, texture))
+    for _ in range(args.empty):
+        empty = np.clip(rng.normal(128, 30, (args.height, args.width)), 0, 255).astype(np.uint8)
+        frames.append((cv.GaussianBlur(empty, (0, 0), 3), None))
+
+    print(f'{len(frames)} frames ({args.frames} with a board), {args.width}x{args.height}, noise {args.noise}')
+    print(f'{"engine":<10}{"ms/frame":>10}{"ms/empty":>10}{"found":>8}{"false":>8}{"err px":>10}{"max px":>10}')
+    for engine in detection_engines:
+        times = []
+        errors = []
+        found = 0
+        false_found = 0
+        for image, truth in frames:
+            start = time.perf_counter()
+            ret, corners = find_chessboard(image, args.rows, args.columns, engine)
+            times.append(time.perf_counter() - start)
+            if ret and truth is not None:
+                found += 1
+                errors.append(corner_error(corners, truth))
+            elif ret:
+                false_found += 1
+
+        times = np.array(times) * 1000
+        board_time = times[:args.frames].mean() if args.frames else float('nan')
+        empty_time = times[args.frames:].mean() if args.empty else float('nan')
+        mean_error = np.mean(errors) if errors else float('nan')
+        max_error = np.max(errors) if errors else float('nan')
+        print(f'{engine:<10}{board_time:>10.1f}{empty_time:>10.1f}{found:>8}{false_found:>8}{mean_error:>10.3f}{max_error:>10.3f}')
+
+if __name__ == '__main__':
+    main()
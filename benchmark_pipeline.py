@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import cv2 as cv
+import numpy as np
+from calibration import calibrate_camera, checkerboard_columns, checkerboard_rows, detect_chessboards, stereo_calibrate
+from frame_store import FrameStore
+from synthetic_rig import default_rig, project_rig_points, random_scene_points, render_stereo_views
+from triangulation import triangulate_points
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+class Stage:
+    """
+    Times a benchmark stage and records its peak traced (numpy/Python) memory.
+    """
+
+    def __init__(self, results, name, items=None):
+        self.results = results
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stage = {'seconds': seconds, 'peak_traced_mb': tracemalloc.get_traced_memory()[1] / 2**20}
+        if self.items:
+            stage['items_per_second'] = self.items / seconds
+        self.results['stages'][self.name] = stage
+
+def rotation_error_deg(R_estimated, R_truth):
+    angle = np.linalg.norm(cv.Rodrigues(R_estimated @ R_truth.T)[0])
+    return float(np.degrees(angle))
+
+def intrinsic_errors(K, dist, K_truth, dist_truth):
+    return {
+        'fx': float(K[0, 0] - K_truth[0, 0]), 'fy': float(K[1, 1] - K_truth[1, 1]),
+        'cx': float(K[0, 2] - K_truth[0, 2]), 'cy': float(K[1, 2] - K_truth[1, 2]),
+        'dist': float(np.abs(np.ravel(dist)[:5] - np.ravel(dist_truth)[:5]).max()),
+    }
+
+def write_frames(views, foldername, frame_format):
+    """
+    Saves the rendered views like the capture does: a frame store or one image per camera and pair.
+
+    Returns:
+        images_camera0, images_camera1 (list): Frame references for the calibration functions.
+    """
+    if frame_format == 'store':
+        store = FrameStore.create(foldername, views[0][0].shape[:2] + (1,))
+        for number, (image0, image1, _, _) in enumerate(views):
+            store.append('camera0', number, 0.0, image0)
+            store.append('camera1', number, 0.0, image1)
+        store.close()
+        store = FrameStore(foldername)
+        return store.frames('camera0'), store.frames('camera1')
+
+    images_camera0, images_camera1 = [], []
+    for number, (image0, image1, _, _) in enumerate(views):
+        for images, name, image in ((images_camera0, 'camera0', image0), (images_camera1, 'camera1', image1)):
+            path = os.path.join(foldername, f'{name}_{number}.{frame_format}')
+            cv.imwrite(path, image)
+            images.append(path)
+    return images_camera0, images_camera1
+
+def run(args):
+    rng = np.random.RandomState(args.seed)
+    np.random.seed(args.seed)
+    rig = default_rig((args.width, args.height))
+    rows, columns = checkerboard_rows, checkerboard_columns
+
+    results = {
+        'config': vars(args),
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv.__version__,
+                        'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'stages': {},
+    }
+
+    tracemalloc.start()
+    with Stage(results, 'render', args.frames):
+        views = render_stereo_views(rig, args.frames, rows, columns, args.noise, rng)
+
+    with tempfile.TemporaryDirectory() as foldername:
+        with Stage(results, 'write', args.frames):
+            images_camera0, images_camera1 = write_frames(views, foldername, args.format)
+
+        # Detection is timed on its own, the calibrations below then read it from the detection cache
+        with Stage(results, 'detection', 2 * args.frames):
+            detections = detect_chessboards(images_camera0 + images_camera1, rows, columns, args.workers, args.engine)
+        results['detected'] = int(sum(ret for ret, _, _ in detections))
+
+        with Stage(results, 'calibrate_camera', 2 * args.frames):
+            mtx1, dist1, rmse1 = calibrate_camera(images_camera0, args.workers, args.engine)
+            mtx2, dist2, rmse2 = calibrate_camera(images_camera1, args.workers, args.engine)
+
+        with Stage(results, 'stereo_calibrate', args.frames):
+            R, T, stereo_rmse, E, F = stereo_calibrate(mtx1, dist1, mtx2, dist2, images_camera0, images_camera1,
+                                                       args.workers, args.engine)
+
+    points = random_scene_points(rig, args.points, rng)
+    uv0, uv1 = project_rig_points(rig, points, args.point_noise, rng)
+    with Stage(results, 'triangulation', args.points):
+        p3ds = triangulate_points(mtx1, mtx2, R, T, uv0, uv1, dist1, dist2)
+    with Stage(results, 'refinement', args.points):
+        refined, reprojection = triangulate_points(mtx1, mtx2, R, T, uv0, uv1, dist1, dist2, refine=True, return_errors=True)
+    tracemalloc.stop()
+
+    errors_3d = np.linalg.norm(p3ds - points, axis=1)
+    refined_errors_3d = np.linalg.norm(refined - points, axis=1)
+    results['accuracy'] = {
+        'rmse_camera0': rmse1, 'rmse_camera1': rmse2, 'rmse_stereo': stereo_rmse,
+        'camera0': intrinsic_errors(mtx1, dist1, rig['K1'], rig['dist1']),
+        'camera1': intrinsic_errors(mtx2, dist2, rig['K2'], rig['dist2']),
+        'rotation_deg': rotation_error_deg(R, rig['R']),
+        'translation': float(np.linalg.norm(np.ravel(T) - np.ravel(rig['T']))),
+        'points_3d_mean': float(errors_3d.mean()),
+        'points_3d_max': float(errors_3d.max()),
+        'points_3d_refined_mean': float(refined_errors_3d.mean()),
+        'reprojection_px_mean': float(reprojection.mean()),
+    }
+    if resource is not None:
+        # Linux reports kilobytes, macOS bytes
+        scale = 1 if platform.system() == 'Darwin' else 1024
+        results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+    return results
+
+def print_results(results, previous=None):
+    print(f"{'stage':<18}{'seconds':>10}{'items/s':>12}{'peak MB':>10}" + (f"{'change':>10}" if previous else ''))
+    for name, stage in results['stages'].items():
+        line = f"{name:<18}{stage['seconds']:>10.3f}{stage.get('items_per_second', float('nan')):>12.1f}{stage['peak_traced_mb']:>10.1f}"
+        if previous and name in previous['stages']:
+            line += f"{stage['seconds'] / previous['stages'][name]['seconds'] - 1:>+10.1%}"
+        print(line)
+
+    print(f"detected boards: {results['detected']} / {2 * results['config']['frames']}")
+    for key, value in results['accuracy'].items():
+        before = previous['accuracy'].get(key) if previous else None
+        print(f'{key}: {value}' + (f' (was {before})' if before is not None else ''))
+    if 'peak_rss_mb' in results:
+        print(f"peak RSS: {results['peak_rss_mb']:.0f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks detection, calibration and triangulation on a synthetic stereo rig.')
+    parser.add_argument('--frames', type=int, default=20, help='number of rendered frame pairs')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--noise', type=float, default=2.0, help='standard deviation of the image noise')
+    parser.add_argument('--points', type=int, default=100000, help='number of triangulated points')
+    parser.add_argument('--point-noise', type=float, default=0.5, help='standard deviation of the pixel noise of the triangulated points')
+    parser.add_argument('--format', default='store', help='frame format: store, png or jpg')
+    parser.add_argument('--engine', default='pyramid', help='checkerboard detection engine')
+    parser.add_argument('--workers', type=int, default=1, help='checkerboard detection processes (0 uses all cores)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    results = run(args)
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved to', args.output)
+
+if __name__ == '__main__':
+    main()
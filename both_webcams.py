@@ -2,11 +2,16 @@ import os
 os.environ["OPENCV_VIDEOIO_MSMF_ENABLE_HW_TRANSFORMS"] = "0"  # Disable hardware transforms for OpenCV on Windows
 import cv2 as cv
 import numpy as np
-from scipy import linalg
-import yaml
-
-# Clear the console screen
-os.system('cls' if os.name == 'nt' else 'clear')
+import queue
+import threading
+import time
+from collections import deque
+import glob
+from calibration import (board_features, checkerboard_columns, checkerboard_rows, coverage_cells, find_chessboard,
+                         rig_spanning_tree)
+from frame_store import FrameStore, StoredFrame, open_frame_store
+from capture_profiles import CaptureProfile, apply_profile, autotune_profile, profile_differences
+import instrumentation
 
 # Global dictionary to store calibration settings
 calibration_settings = {}
@@ -20,8 +25,6 @@ def parse_calibration_settings_file(filename):
 
     Exits the program if the file does not exist or if required keys are missing.
     """
-    global calibration_settings
-
     # Check if the file exists
     if not os.path.exists(filename):
         print('File does not exist:', filename)
@@ -29,19 +32,586 @@ def parse_calibration_settings_file(filename):
 
     print('Using for calibration settings:', filename)
 
+    # Only the settings parser needs yaml
+    import yaml
+
     # Load the YAML file into the global dictionary
+    # (updated in place so modules that imported it with 'from both_webcams import *' see the values)
     with open(filename) as f:
-        calibration_settings = yaml.safe_load(f)
+        calibration_settings.clear()
+        calibration_settings.update(yaml.safe_load(f))
 
     # Basic validation to ensure the correct file is loaded
     if 'camera0' not in calibration_settings.keys():
         print('The key "camera0" was not found in the settings file. Verify if the correct calibration_settings.yaml file was provided.')
         quit()
 
+def open_camera(camera_name):
+    """
+    Opens the video stream of a camera with the capture profile from the calibration settings.
+
+    With 'capture_fourcc' auto, the pixel formats and frame rates of the camera are probed once and the best
+    mode for the resolution and 'capture_fps' is cached in 'capture_profile_cache'. A warning is printed
+    when the driver grants something else than requested.
+
+    Parameters:
+        camera_name (str): Key for the camera in the calibration settings.
+    """
+    device = calibration_settings[camera_name]
+    width = calibration_settings['frame_width']
+    height = calibration_settings['frame_height']
+    target_fps = calibration_settings['capture_fps']
+    buffer_size = calibration_settings['capture_buffer_size']
+
+    if calibration_settings['capture_fourcc'] == 'auto':
+        profile = autotune_profile(device, width, height, target_fps, buffer_size, calibration_settings['capture_profile_cache'])
+    else:
+        profile = CaptureProfile(calibration_settings['capture_fourcc'], width, height, target_fps, buffer_size)
+
+    cap = cv.VideoCapture(device)
+    granted = apply_profile(cap, profile)
+    differences = profile_differences(profile, granted)
+    if differences:
+        print(f'Warning: {camera_name} did not grant the requested capture mode ({", ".join(differences)})')
+    return cap
+
+class RigCapture:
+    """
+    Reads any number of cameras on background threads, one per camera.
+
+    All threads meet at a barrier and call grab() at the same time, then retrieve() (the slow decode)
+    independently, so the exposure skew between the cameras is not a full frame decode. Each camera keeps
+    a small ring buffer of (sequence number, timestamp, frame) and read_all() returns the latest frames
+    grabbed in the same round, together with the measured inter-camera skew.
+    """
+
+    def __init__(self, camera_names, buffer_size=4):
+        self.caps = [open_camera(camera_name) for camera_name in camera_names]
+        self.buffers = [deque(maxlen=buffer_size) for _ in camera_names]
+        self.new_frame = threading.Condition()
+        self.barrier = threading.Barrier(len(camera_names))
+        self.running = False
+        self.failed = False
+        self.last_sequence = -1
+        self.threads = []
+        self.live = True
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self._reader, args=(i,), daemon=True) for i in range(len(self.caps))]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _reader(self, index):
+        cap = self.caps[index]
+        sequence = 0
+        while self.running:
+            try:
+                self.barrier.wait()
+            except threading.BrokenBarrierError:
+                break
+
+            # grab() only latches the frame, it is called by every thread right after the barrier
+            ret = cap.grab()
+            timestamp = time.perf_counter()
+            if ret:
+                ret, frame = cap.retrieve()
+
+            with self.new_frame:
+                if not ret:
+                    self.failed = True
+                    self.barrier.abort()
+                else:
+                    self.buffers[index].append((sequence, timestamp, frame))
+                self.new_frame.notify_all()
+            sequence += 1
+
+    def _latest_round(self):
+        # Latest sequence number present in every ring buffer
+        others = [{entry[0]: entry for entry in buffer} for buffer in self.buffers[1:]]
+        for entry0 in reversed(self.buffers[0]):
+            if all(entry0[0] in sequences for sequences in others):
+                return [entry0] + [sequences[entry0[0]] for sequences in others]
+        return None
+
+    def read_all(self, timeout=2.0):
+        """
+        Waits for a synchronized round newer than the last one returned.
+
+        Returns:
+            ret (bool): False if a camera stopped returning frames.
+            frames (list): Frames of every camera grabbed in the same round.
+            skew (float): Time between the first and the last grab() call, in seconds.
+        """
+        with self.new_frame:
+            def ready():
+                entries = self._latest_round()
+                return self.failed or (entries is not None and entries[0][0] > self.last_sequence)
+
+            if not self.new_frame.wait_for(ready, timeout) or self.failed:
+                return False, None, None
+
+            entries = self._latest_round()
+            sequence = entries[0][0]
+            if self.last_sequence >= 0:
+                # Rounds grabbed since the last read that were never returned
+                instrumentation.count('capture.dropped_pairs', sequence - self.last_sequence - 1)
+            self.last_sequence = sequence
+
+        timestamps = [entry[1] for entry in entries]
+        return True, [entry[2] for entry in entries], max(timestamps) - min(timestamps)
+
+    def release(self):
+        self.running = False
+        self.barrier.abort()
+        for thread in self.threads:
+            thread.join()
+        for cap in self.caps:
+            cap.release()
+
+class StereoCapture(RigCapture):
+    """
+    RigCapture of two cameras whose read() returns the pair directly.
+    """
+
+    def __init__(self, camera0_name, camera1_name, buffer_size=4):
+        super().__init__([camera0_name, camera1_name], buffer_size)
+
+    def read(self, timeout=2.0):
+        """
+        Waits for a synchronized pair newer than the last one returned.
+
+        Returns:
+            ret (bool): False if a camera stopped returning frames.
+            frame0, frame1 (numpy.ndarray): Frames grabbed in the same round.
+            skew (float): Time between the two grab() calls, in seconds.
+        """
+        ret, frames, skew = self.read_all(timeout)
+        if not ret:
+            return False, None, None, None
+        return True, frames[0], frames[1], skew
+
+def list_image_files(foldername):
+    """
+    Lists the image files of a folder, sorted by name.
+    """
+    return sorted(path for path in glob.glob(os.path.join(foldername, '*'))
+                  if os.path.splitext(path)[1].lower() in ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp'))
+
+def list_replay_frames(source, camera_name, save_format=None):
+    """
+    Lists the frames of one camera in an image folder or a frame store folder.
+
+    In an image folder, the images whose name contains the camera name are used if there are any,
+    otherwise all the images of the folder.
+
+    Parameters:
+        source (str): Folder of the frames.
+        camera_name (str): Camera name.
+        save_format (str): Format the frames were saved in ('store', 'png', 'jpg' or 'webp'), so a session of
+            another format left in the folder is not read. None detects it (frame store first), for recordings.
+    """
+    if save_format == 'store' or (save_format is None and FrameStore.exists(source)):
+        return FrameStore(source).frames(camera_name) if FrameStore.exists(source) else []
+
+    images = list_image_files(source)
+    if save_format is not None:
+        images = [path for path in images if os.path.splitext(path)[1].lower() == '.' + save_format]
+    named = [path for path in images if camera_name in os.path.basename(path)]
+    return named if named else images
+
+class ReplaySource:
+    """
+    Replays the frames of one camera from a video file, an image folder or a frame store folder.
+    """
+
+    def __init__(self, source, camera_name):
+        self.video = None
+        self.frames = None
+        self.position = 0
+        self.fps = None
+
+        if os.path.isdir(source):
+            self.frames = list_replay_frames(source, camera_name)
+            if not self.frames:
+                print('No frames to replay in:', source)
+                quit()
+        else:
+            if not os.path.exists(source):
+                print('Replay file does not exist:', source)
+                quit()
+            self.video = cv.VideoCapture(source)
+            self.fps = self.video.get(cv.CAP_PROP_FPS) or None
+
+    def read(self):
+        if self.video is not None:
+            return self.video.read()
+
+        if self.position >= len(self.frames):
+            return False, None
+        frame = self.frames[self.position]
+        self.position += 1
+
+        if isinstance(frame, StoredFrame):
+            # Frame stores hold grayscale frames, the capture loops work on BGR
+            image = open_frame_store(frame.foldername).image(frame.index)
+            return True, cv.cvtColor(image, cv.COLOR_GRAY2BGR) if image.ndim == 2 else np.array(image)
+        return True, cv.imread(frame)
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+
+class RigReplayCapture:
+    """
+    Offline replacement for RigCapture: replays recorded frames of every camera with the same read_all() interface.
+
+    With speed 'native' the rounds are paced at the recording frame rate (the video frame rate, or 'fps' for
+    image folders), with speed 'max' they are returned as fast as they can be read. Every recorded round is
+    returned exactly once, so runs are reproducible.
+    """
+
+    def __init__(self, sources, camera_names, speed='max', fps=30):
+        self.sources = [ReplaySource(source, camera_name) for source, camera_name in zip(sources, camera_names)]
+        self.speed = speed
+        self.period = 1. / (self.sources[0].fps or fps)
+        self.next_time = None
+        self.live = False
+
+    def start(self):
+        self.next_time = time.perf_counter()
+        return self
+
+    def read_all(self):
+        frames = []
+        for source in self.sources:
+            ret, frame = source.read()
+            if not ret:
+                return False, None, None
+            frames.append(frame)
+
+        if self.speed == 'native':
+            # Wait for the capture time of this round
+            delay = self.next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time += self.period
+
+        return True, frames, 0.0
+
+    def release(self):
+        for source in self.sources:
+            source.release()
+
+class ReplayCapture(RigReplayCapture):
+    """
+    Offline replacement for StereoCapture: replays recorded frames of both cameras with the same read() interface.
+    """
+
+    def __init__(self, source0, source1, camera0_name='camera0', camera1_name='camera1', speed='max', fps=30):
+        super().__init__([source0, source1], [camera0_name, camera1_name], speed, fps)
+
+    def read(self):
+        ret, frames, skew = self.read_all()
+        if not ret:
+            return False, None, None, None
+        return True, frames[0], frames[1], skew
+
+def open_stereo_source(camera0_name, camera1_name):
+    """
+    Opens the pair source selected by the 'frame_source' setting: the live cameras, or a replay of the
+    recordings in 'replay_camera0' / 'replay_camera1'.
+    """
+    if calibration_settings['frame_source'] == 'replay':
+        return ReplayCapture(calibration_settings['replay_camera0'], calibration_settings['replay_camera1'],
+                             camera0_name, camera1_name, calibration_settings['replay_speed']).start()
+    return StereoCapture(camera0_name, camera1_name).start()
+
+def rig_cameras():
+    """
+    Returns the camera keys of the rig listed in the 'cameras' setting (camera0 and camera1 by default).
+    """
+    return calibration_settings.get('cameras') or ['camera0', 'camera1']
+
+def open_rig_source(camera_names):
+    """
+    Opens the source of every camera of the rig: the live cameras, or a replay of the recordings in
+    'replay_<camera name>' when 'frame_source' is replay.
+    """
+    if calibration_settings['frame_source'] == 'replay':
+        sources = [calibration_settings['replay_' + camera_name] for camera_name in camera_names]
+        return RigReplayCapture(sources, camera_names, calibration_settings['replay_speed']).start()
+    return RigCapture(camera_names).start()
+
+def show_preview(*frames_small):
+    """
+    Displays the preview frames and returns the pressed key (-1 without windows in headless mode).
+    """
+    if calibration_settings['headless']:
+        return -1
+    for index, frame_small in enumerate(frames_small):
+        cv.imshow('frame%d_small' % index, frame_small)
+    return cv.waitKey(1)
+
+class FrameWriter:
+    """
+    Writes frames to disk on a background thread, as image files or appended to a FrameStore.
+
+    write() only enqueues the frame. The queue is bounded: when the disk cannot keep up, write() waits for
+    a free slot and the wait is counted as back-pressure (see the summary printed by close()). close() blocks
+    until every queued frame is on disk.
+
+    If writing a frame fails (e.g. frames of a different shape appended to the store), the writer thread
+    keeps draining the queue without writing, and the next write() or close() raises the error.
+    """
+
+    # Encoder parameter for the compression level / quality of each supported format
+    encoder_params = {
+        'png': cv.IMWRITE_PNG_COMPRESSION,  # 0 (no compression, fastest) to 9
+        'jpg': cv.IMWRITE_JPEG_QUALITY,  # 0 to 100
+        'webp': cv.IMWRITE_WEBP_QUALITY,  # 1 to 100
+    }
+
+    def __init__(self, foldername, extension='png', compression=0, queue_size=8):
+        """
+        Parameters:
+            foldername (str): Folder the frames are saved to.
+            extension (str): 'png', 'jpg', 'webp', or 'store' for a grayscale FrameStore (no image encoding).
+            compression (int): PNG compression level or JPG/WebP quality (ignored for 'store').
+            queue_size (int): Maximum number of frames waiting to be written.
+        """
+        if extension != 'store' and extension not in self.encoder_params:
+            print('Unsupported image format:', extension)
+            quit()
+
+        self.foldername = foldername
+        self.extension = extension
+        self.params = [self.encoder_params[extension], compression] if extension in self.encoder_params else []
+        self.store = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.blocked_count = 0
+        self.blocked_time = 0.0
+        self.error = None
+        self.remove_other_formats()
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def remove_other_formats(self):
+        """
+        Deletes the frames of another format left in the folder by a previous session, so they are not
+        read back as part of this one.
+        """
+        if not os.path.isdir(self.foldername):
+            return
+        if self.extension != 'store' and FrameStore.exists(self.foldername):
+            print('Removing the frame store of a previous session in:', self.foldername)
+            FrameStore.remove(self.foldername)
+        leftovers = [path for path in list_image_files(self.foldername)
+                     if os.path.splitext(path)[1].lower() != '.' + self.extension]
+        if leftovers:
+            print(f'Removing {len(leftovers)} image files of a previous session in:', self.foldername)
+            for path in leftovers:
+                os.remove(path)
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            camera_name, number, timestamp, frame = item
+
+            # After a failure the queue is only drained, so write() never waits on a writer that stopped writing
+            if self.error is None:
+                try:
+                    self._write_frame(camera_name, number, timestamp, frame)
+                except Exception as error:
+                    print(f'Frame writer failed on {camera_name} frame {number}:', error)
+                    instrumentation.count('writer.failures')
+                    self.error = error
+            self.queue.task_done()
+
+    def _write_frame(self, camera_name, number, timestamp, frame):
+        if self.extension == 'store':
+            # The session store is created with the shape of the first frame
+            if self.store is None:
+                self.store = FrameStore.create(self.foldername, frame.shape[:2] + (1,))
+            with instrumentation.timer('writer.store_append'):
+                self.store.append(camera_name, number, timestamp, frame)
+        else:
+            path = os.path.join(self.foldername, f'{camera_name}_{number}.{self.extension}')
+            with instrumentation.timer('writer.imwrite'):
+                written = cv.imwrite(path, frame, self.params)
+            if not written:
+                print('Could not write frame:', path)
+                instrumentation.count('writer.failures')
+
+    def check(self):
+        """
+        Raises the error that stopped the writer, if any.
+        """
+        if self.error is not None:
+            raise RuntimeError(f'The frame writer stopped after an error: {self.error}') from self.error
+
+    def write(self, camera_name, number, frame, timestamp=None):
+        self.check()
+        item = (camera_name, number, time.time() if timestamp is None else timestamp, frame)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Back-pressure: the disk is slower than the capture, wait for the writer
+            start = time.perf_counter()
+            self.queue.put(item)
+            self.blocked_count += 1
+            instrumentation.count('writer.backpressure')
+            self.blocked_time += time.perf_counter() - start
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def close(self):
+        # Flush all queued frames before returning
+        self.queue.put(None)
+        self.thread.join()
+        if self.store is not None:
+            self.store.close()
+        if self.blocked_count:
+            print(f'Frame writer: waited {self.blocked_count} times ({self.blocked_time:.2f} s) for a full queue')
+        self.check()
+
+class BoardDetector:
+    """
+    Looks for the checkerboard in the preview frames of every camera on a background thread.
+
+    submit() never blocks: the detector only keeps the most recent round, older rounds that were not
+    processed yet are dropped. result() returns the latest finished detection together with the full
+    resolution frames it was run on, so the accepted round is exactly the round where the board was seen.
+
+    With background=False every round is detected inside submit(), so replays are reproducible.
+    """
+
+    def __init__(self, rows, columns, background=True, engine='pyramid'):
+        self.rows = rows
+        self.columns = columns
+        self.engine = engine  # The fast check of the pyramid engine rejects frames without a board in a few ms
+        self.condition = threading.Condition()
+        self.job = None
+        self.latest = None
+        self.running = True
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def _detect(self, job):
+        frames, frames_small = job
+        found = []
+        with instrumentation.timer('live_detection'):
+            for small in frames_small:
+                gray = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+                ret, corners = find_chessboard(gray, self.rows, self.columns, self.engine)
+                found.append(corners.reshape(-1, 2) if ret else None)
+        if any(corners is None for corners in found):
+            instrumentation.count('live_detection.rejected_pairs')
+
+        with self.condition:
+            self.latest = (frames, found)
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.job is not None or not self.running)
+                if not self.running:
+                    break
+                job = self.job
+                self.job = None
+
+            self._detect(job)
+
+    def submit(self, frames, frames_small):
+        if self.thread is None:
+            self._detect((frames, frames_small))
+            return
+        with self.condition:
+            self.job = (frames, [small.copy() for small in frames_small])
+            self.condition.notify()
+
+    def result(self):
+        """
+        Returns (frames, corners) of the last processed round and forgets it, or None.
+        Corners are in preview coordinates, one entry per camera, None where the board was not found.
+        """
+        with self.condition:
+            latest = self.latest
+            self.latest = None
+        return latest
+
+    def stop(self):
+        if self.thread is None:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+class CoverageTracker:
+    """
+    Tracks where the accepted boards fall in each image and how varied their poses are.
+
+    Image coverage is the fraction of cells of a grid_size x grid_size grid that contain at least one corner.
+    Pose diversity is the number of distinct (scale, horizontal tilt, vertical tilt) bins seen in the first camera.
+    Both use the board measures of the calibration frame selection (calibration.coverage_cells and
+    calibration.board_features), so the capture and the selection agree on what is covered.
+    """
+
+    # Bin edges of the board scale, and of the tilts (a board tilted around one axis has one side noticeably
+    # longer than the opposite one)
+    scale_edges = [0.2, 0.35]
+    tilt_edges = [-np.log(1.1), np.log(1.1)]
+
+    def __init__(self, grid_size):
+        self.grid_size = grid_size
+        self.counts = [np.zeros((grid_size, grid_size), np.int32), np.zeros((grid_size, grid_size), np.int32)]
+        self.pose_bins = set()
+
+    def pose_bin(self, corners, image_size):
+        _, _, scale, horizontal_tilt, vertical_tilt = board_features(corners, image_size)
+        return (int(np.digitize(scale, self.scale_edges)), int(np.digitize(horizontal_tilt, self.tilt_edges)),
+                int(np.digitize(vertical_tilt, self.tilt_edges)))
+
+    def add(self, corners0, corners1, shape):
+        image_size = (shape[1], shape[0])
+        for counts, corners in zip(self.counts, (corners0, corners1)):
+            for x, y in coverage_cells(corners, image_size, self.grid_size):
+                counts[y, x] += 1
+        self.pose_bins.add(self.pose_bin(corners0, image_size))
+
+    def coverage(self):
+        return min(np.count_nonzero(counts) / counts.size for counts in self.counts)
+
+    def diversity(self):
+        return len(self.pose_bins)
+
+    def draw(self, frame, camera_index):
+        """
+        Blends the coverage heatmap of one camera over its preview frame (in place).
+        """
+        counts = self.counts[camera_index]
+        heat = np.clip(counts * (255 // 3), 0, 255).astype(np.uint8)
+        heat = cv.resize(heat, (frame.shape[1], frame.shape[0]), interpolation=cv.INTER_NEAREST)
+        overlay = frame.copy()
+        overlay[:, :, 1] = np.maximum(overlay[:, :, 1], heat)
+        cv.addWeighted(overlay, 0.4, frame, 0.6, 0, dst=frame)
+
 def save_frames_two_cams(camera0_name, camera1_name, foldername):
     """
     Captures and saves frames from two cameras simultaneously.
 
+    A pair is only saved when the checkerboard is detected in both views. Capture stops once the boards
+    cover enough of both images with enough different poses (and at least 'stereo_calibration_frames' pairs
+    are saved), or when 'max_calibration_frames' pairs are saved.
+
     Parameters:
         camera0_name (str): Key for the first camera in the calibration settings.
         camera1_name (str): Key for the second camera in the calibration settings.
@@ -53,36 +623,57 @@ def save_frames_two_cams(camera0_name, camera1_name, foldername):
     # Retrieve settings for capturing frames
     view_resize = calibration_settings['view_resize']
     cooldown_time = calibration_settings['cooldown']
-    number_to_save = calibration_settings['stereo_calibration_frames']
+    min_to_save = calibration_settings['stereo_calibration_frames']
+    max_to_save = calibration_settings['max_calibration_frames']
+    coverage_target = calibration_settings['coverage_target']
+    diversity_target = calibration_settings['pose_diversity_target']
 
-    # Open the video streams for both cameras
-    cap0 = cv.VideoCapture(calibration_settings[camera0_name])
-    cap1 = cv.VideoCapture(calibration_settings[camera1_name])
+    # Open the video streams for both cameras (or the replayed recordings)
+    capture = open_stereo_source(camera0_name, camera1_name)
 
-    # Set camera resolutions
-    width = calibration_settings['frame_width']
-    height = calibration_settings['frame_height']
-    cap0.set(3, width)  # Set width for camera 0
-    cap0.set(4, height)  # Set height for camera 0
-    cap1.set(3, width)  # Set width for camera 1
-    cap1.set(4, height)  # Set height for camera 1
+    # Frames are written to disk on a background thread
+    writer = FrameWriter(foldername, calibration_settings['save_format'], calibration_settings['save_compression'])
+
+    # The checkerboard is searched in the preview frames on a background thread
+    # (replays are detected synchronously, so every pair gets a detection and runs are reproducible)
+    detector = BoardDetector(checkerboard_rows, checkerboard_columns, background=capture.live)
+    coverage = CoverageTracker(calibration_settings['coverage_grid'])
 
     cooldown = cooldown_time
-    start = False
+    start = calibration_settings['headless']  # Without windows, capture starts immediately
     saved_count = 0
+    seen = (None, None)  # Last detection in each preview, drawn on the frames
+
+    def stop():
+        capture.release()
+        detector.stop()
+        writer.close()
 
     while True:
-        # Read frames from both cameras
-        ret0, frame0 = cap0.read()
-        ret1, frame1 = cap1.read()
+        # Get the latest synchronized pair from both cameras
+        with instrumentation.timer('capture.read'):
+            ret, frame0, frame1, skew = capture.read()
+
+        if not ret and not capture.live:
+            print('End of the replayed frames.')
+            break
 
-        if not ret0 or not ret1:
+        if not ret:
             print('Cameras are not returning video data. Exiting...')
+            stop()
             quit()
 
         # Resize frames for display (only for visualization, not for saving)
-        frame0_small = cv.resize(frame0, None, fx=1./view_resize, fy=1./view_resize)
-        frame1_small = cv.resize(frame1, None, fx=1./view_resize, fy=1./view_resize)
+        instrumentation.count('capture.frames')
+        with instrumentation.timer('preview.resize'):
+            frame0_small = cv.resize(frame0, None, fx=1./view_resize, fy=1./view_resize)
+            frame1_small = cv.resize(frame1, None, fx=1./view_resize, fy=1./view_resize)
+
+        # Look for the board in this pair while the next one is captured
+        detector.submit((frame0, frame1), (frame0_small, frame1_small))
+        detection = detector.result()
+        if detection is not None:
+            seen = detection[1]
 
         if not start:
             # Display instructions to ensure both cameras can see the calibration pattern
@@ -92,46 +683,62 @@ def save_frames_two_cams(camera0_name, camera1_name, foldername):
         if start:
             # Decrease the cooldown timer
             cooldown -= 1
-            cv.putText(frame0_small, "Cooldown: " + str(cooldown), (50, 50), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
-            cv.putText(frame0_small, "Num frames: " + str(saved_count), (50, 100), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
 
-            cv.putText(frame1_small, "Cooldown: " + str(cooldown), (50, 50), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
-            cv.putText(frame1_small, "Num frames: " + str(saved_count), (50, 100), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+            # Save a pair when cooldown reaches 0 and the board was found in both views
+            if cooldown <= 0 and detection is not None and detection[1][0] is not None and detection[1][1] is not None:
+                (detected0, detected1), (corners0, corners1) = detection
 
-            # Save frames when cooldown reaches 0
-            if cooldown <= 0:
-                # Save images in PNG format for lossless compression
-                savename0 = os.path.join(foldername, f'{camera0_name}_{saved_count}.png')
-                savename1 = os.path.join(foldername, f'{camera1_name}_{saved_count}.png')
-
-                # Save the frames with maximum quality
-                cv.imwrite(savename0, frame0, [cv.IMWRITE_PNG_COMPRESSION, 0])  # PNG compression level 0 (no compression)
-                cv.imwrite(savename1, frame1, [cv.IMWRITE_PNG_COMPRESSION, 0])  # PNG compression level 0 (no compression)
+                # Queue the frames for saving with the configured format and compression
+                timestamp = time.time()
+                writer.write(camera0_name, saved_count, detected0, timestamp)
+                writer.write(camera1_name, saved_count, detected1, timestamp)
+                coverage.add(corners0, corners1, frame0_small.shape)
 
                 saved_count += 1
+                instrumentation.count('capture.saved_pairs')
                 cooldown = cooldown_time  # Reset cooldown timer
 
+            with instrumentation.timer('preview.draw'):
+                for frame_small, camera_index in ((frame0_small, 0), (frame1_small, 1)):
+                    coverage.draw(frame_small, camera_index)
+                    cv.putText(frame_small, "Cooldown: " + str(max(cooldown, 0)), (50, 50), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+                    cv.putText(frame_small, "Num frames: " + str(saved_count), (50, 100), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+
+            cv.putText(frame0_small, "Coverage: %d%% / %d%%" % (coverage.coverage() * 100, coverage_target * 100), (50, 150), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+            cv.putText(frame0_small, "Poses: %d / %d" % (coverage.diversity(), diversity_target), (50, 200), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+            cv.putText(frame1_small, "Skew: %.1f ms" % (skew * 1000), (50, 150), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+            cv.putText(frame1_small, "Write queue: " + str(writer.pending()), (50, 200), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+
+        # Show the last detected corners (green when found in both views)
+        color = (0, 255, 0) if seen[0] is not None and seen[1] is not None else (0, 0, 255)
+        for frame_small, corners in zip((frame0_small, frame1_small), seen):
+            if corners is not None:
+                for x, y in corners.astype(int):
+                    cv.circle(frame_small, (int(x), int(y)), 3, color, -1)
+
         # Display the resized frames
-        cv.imshow('frame0_small', frame0_small)
-        cv.imshow('frame1_small', frame1_small)
-        k = cv.waitKey(1)
+        with instrumentation.timer('preview.show'):
+            k = show_preview(frame0_small, frame1_small)
 
         if k == 27:  # ESC key
             # Exit the program if ESC is pressed
+            stop()
             quit()
 
         if k == 32:  # Spacebar
             # Start capturing frames when SPACEBAR is pressed
             start = True
 
-        # Exit the loop when the required number of frames is saved
-        if saved_count == number_to_save:
+        # Exit the loop when the boards cover the images well enough, or when the maximum number of frames is saved
+        targets_met = coverage.coverage() >= coverage_target and coverage.diversity() >= diversity_target
+        if (targets_met and saved_count >= min_to_save) or saved_count >= max_to_save:
             break
 
-    # Release video streams and close all OpenCV windows
-    cap0.release()
-    cap1.release()
-    cv.destroyAllWindows()
+    # Release video streams, wait for the pending writes and close all OpenCV windows
+    stop()
+    if not calibration_settings['headless']:
+        cv.destroyAllWindows()
+    print(f'Saved {saved_count} frame pairs (coverage {coverage.coverage():.0%}, {coverage.diversity()} poses)')
 
 def save_single_frame_two_cams(camera0_name, camera1_name, foldername):
     """
@@ -150,34 +757,36 @@ def save_single_frame_two_cams(camera0_name, camera1_name, foldername):
     cooldown_time = calibration_settings['cooldown']
     number_to_save = 1
 
-    # Open the video streams for both cameras
-    cap0 = cv.VideoCapture(calibration_settings[camera0_name])
-    cap1 = cv.VideoCapture(calibration_settings[camera1_name])
+    # Open the video streams for both cameras (or the replayed recordings)
+    capture = open_stereo_source(camera0_name, camera1_name)
 
-    # Set camera resolutions
-    width = calibration_settings['frame_width']
-    height = calibration_settings['frame_height']
-    cap0.set(3, width)  # Set width for camera 0
-    cap0.set(4, height)  # Set height for camera 0
-    cap1.set(3, width)  # Set width for camera 1
-    cap1.set(4, height)  # Set height for camera 1
+    # Frames are written to disk on a background thread, as uncompressed PNG (the later stages read these paths)
+    writer = FrameWriter(foldername, 'png', 0)
 
     cooldown = cooldown_time
-    start = False
+    start = calibration_settings['headless']  # Without windows, capture starts immediately
     saved_count = 0
 
     while True:
-        # Read frames from both cameras
-        ret0, frame0 = cap0.read()
-        ret1, frame1 = cap1.read()
+        # Get the latest synchronized pair from both cameras
+        with instrumentation.timer('capture.read'):
+            ret, frame0, frame1, skew = capture.read()
+
+        if not ret and not capture.live:
+            print('End of the replayed frames.')
+            break
 
-        if not ret0 or not ret1:
+        if not ret:
             print('Cameras are not returning video data. Exiting...')
+            capture.release()
+            writer.close()
             quit()
 
         # Resize frames for display (only for visualization, not for saving)
-        frame0_small = cv.resize(frame0, None, fx=1./view_resize, fy=1./view_resize)
-        frame1_small = cv.resize(frame1, None, fx=1./view_resize, fy=1./view_resize)
+        instrumentation.count('capture.frames')
+        with instrumentation.timer('preview.resize'):
+            frame0_small = cv.resize(frame0, None, fx=1./view_resize, fy=1./view_resize)
+            frame1_small = cv.resize(frame1, None, fx=1./view_resize, fy=1./view_resize)
 
         if not start:
             # Display instructions to ensure both cameras can see the calibration pattern
@@ -185,21 +794,19 @@ def save_single_frame_two_cams(camera0_name, camera1_name, foldername):
             cv.putText(frame0_small, "Press SPACEBAR to capture the frame", (50, 100), cv.FONT_HERSHEY_COMPLEX, 1, (0, 0, 255), 1)
 
         if start:
-            savename0 = os.path.join(foldername, f'{camera0_name}_{saved_count}.png')
-            savename1 = os.path.join(foldername, f'{camera1_name}_{saved_count}.png')
-
-             # Save the frames with maximum quality
-            cv.imwrite(savename0, frame0, [cv.IMWRITE_PNG_COMPRESSION, 0])  # PNG compression level 0 (no compression)
-            cv.imwrite(savename1, frame1, [cv.IMWRITE_PNG_COMPRESSION, 0])  # PNG compression level 0 (no compression)
+            # Queue the frames for saving with maximum quality
+            writer.write(camera0_name, saved_count, frame0)
+            writer.write(camera1_name, saved_count, frame1)
             saved_count += 1
 
         # Display the resized frames
-        cv.imshow('frame0_small', frame0_small)
-        cv.imshow('frame1_small', frame1_small)
-        k = cv.waitKey(1)
+        with instrumentation.timer('preview.show'):
+            k = show_preview(frame0_small, frame1_small)
 
         if k == 27:  # ESC key
             # Exit the program if ESC is pressed
+            capture.release()
+            writer.close()
             quit()
 
         if k == 32:  # Spacebar
@@ -210,10 +817,172 @@ def save_single_frame_two_cams(camera0_name, camera1_name, foldername):
         if saved_count == number_to_save:
             break
 
-    # Release video streams and close all OpenCV windows
-    cap0.release()
-    cap1.release()
-    cv.destroyAllWindows()
+    # Release video streams, wait for the pending writes and close all OpenCV windows
+    capture.release()
+    writer.close()
+    if not calibration_settings['headless']:
+        cv.destroyAllWindows()
+
+def save_frames_rig(camera_names, foldername):
+    """
+    Captures and saves calibration frames from every camera of a rig simultaneously.
+
+    After each cooldown the checkerboard is searched in the previews on a background thread (see BoardDetector)
+    and a round is saved when at least two cameras see it. Capture stops once every camera is linked to the
+    first one through pairs that saw the board together in at least 'stereo_calibration_frames' rounds,
+    or when 'max_calibration_frames' rounds are saved.
+
+    Parameters:
+        camera_names (list): Keys of the cameras in the calibration settings.
+        foldername (str): Folder the frames are saved to.
+    """
+    if not os.path.exists(foldername):
+        os.mkdir(foldername)
+
+    # Retrieve settings for capturing frames
+    view_resize = calibration_settings['view_resize']
+    cooldown_time = calibration_settings['cooldown']
+    min_to_save = calibration_settings['stereo_calibration_frames']
+    max_to_save = calibration_settings['max_calibration_frames']
+
+    # Open the video streams of every camera (or the replayed recordings)
+    capture = open_rig_source(camera_names)
+    writer = FrameWriter(foldername, calibration_settings['save_format'], calibration_settings['save_compression'])
+    # Board detection runs on its own thread (newest round only) so the capture and preview never wait for it
+    detector = BoardDetector(checkerboard_rows, checkerboard_columns, background=capture.live)
+
+    def stop():
+        capture.release()
+        detector.stop()
+        writer.close()
+
+    # Number of saved rounds in which each pair of cameras saw the board together
+    shared = np.zeros((len(camera_names), len(camera_names)), np.int32)
+    cooldown = cooldown_time
+    start = calibration_settings['headless']  # Without windows, capture starts immediately
+    saved_count = 0
+
+    while True:
+        # Get the latest synchronized round from every camera
+        with instrumentation.timer('capture.read'):
+            ret, frames, skew = capture.read_all()
+
+        if not ret and not capture.live:
+            print('End of the replayed frames.')
+            break
+
+        if not ret:
+            print('Cameras are not returning video data. Exiting...')
+            stop()
+            quit()
+
+        # Resize frames for display (only for visualization, not for saving)
+        instrumentation.count('capture.frames')
+        with instrumentation.timer('preview.resize'):
+            frames_small = [cv.resize(frame, None, fx=1./view_resize, fy=1./view_resize) for frame in frames]
+
+        if not start:
+            cv.putText(frames_small[0], "Show the calibration pattern to the cameras", (50, 50), cv.FONT_HERSHEY_COMPLEX, 1, (0, 0, 255), 1)
+            cv.putText(frames_small[0], "Press SPACEBAR to start capturing frames", (50, 100), cv.FONT_HERSHEY_COMPLEX, 1, (0, 0, 255), 1)
+
+        if start:
+            cooldown -= 1
+
+            # Save a round when cooldown reaches 0 and at least two cameras saw the board in it
+            if cooldown <= 0:
+                detector.submit(frames, frames_small)
+                detection = detector.result()
+                found = np.array([corners is not None for corners in detection[1]]) if detection is not None else None
+                if found is not None and np.count_nonzero(found) >= 2:
+                    timestamp = time.time()
+                    for camera_name, frame in zip(camera_names, detection[0]):
+                        writer.write(camera_name, saved_count, frame, timestamp)
+                    shared += np.outer(found, found)
+
+                    saved_count += 1
+                    instrumentation.count('capture.saved_pairs')
+                    cooldown = cooldown_time
+
+            for frame_small in frames_small:
+                cv.putText(frame_small, "Cooldown: " + str(max(cooldown, 0)), (50, 50), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+                cv.putText(frame_small, "Num frames: " + str(saved_count), (50, 100), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+            cv.putText(frames_small[0], "Skew: %.1f ms" % (skew * 1000), (50, 150), cv.FONT_HERSHEY_COMPLEX, 1, (0, 255, 0), 1)
+
+        # Display the resized frames
+        with instrumentation.timer('preview.show'):
+            k = show_preview(*frames_small)
+
+        if k == 27:  # ESC key
+            stop()
+            quit()
+
+        if k == 32:  # Spacebar
+            start = True
+
+        # Exit the loop when every camera can be chained to the first one, or when the maximum number of rounds is saved
+        linked = len(rig_spanning_tree(shared, min_to_save)) == len(camera_names) - 1
+        if linked or saved_count >= max_to_save:
+            break
+
+    # Release video streams, wait for the pending writes and close all OpenCV windows
+    stop()
+    if not calibration_settings['headless']:
+        cv.destroyAllWindows()
+    print(f'Saved {saved_count} frame rounds')
+
+def save_single_frame_rig(camera_names, foldername):
+    """
+    Captures and saves one frame from every camera of a rig simultaneously (as '<camera name>_0.png').
+
+    Parameters:
+        camera_names (list): Keys of the cameras in the calibration settings.
+        foldername (str): Folder the frames are saved to.
+    """
+    if not os.path.exists(foldername):
+        os.mkdir(foldername)
+
+    capture = open_rig_source(camera_names)
+    writer = FrameWriter(foldername, 'png', 0)
+    view_resize = calibration_settings['view_resize']
+    start = calibration_settings['headless']  # Without windows, capture starts immediately
+
+    while True:
+        with instrumentation.timer('capture.read'):
+            ret, frames, skew = capture.read_all()
+
+        if not ret and not capture.live:
+            print('End of the replayed frames.')
+            break
+
+        if not ret:
+            print('Cameras are not returning video data. Exiting...')
+            capture.release()
+            writer.close()
+            quit()
+
+        if start:
+            # Queue the frames for saving with maximum quality
+            for camera_name, frame in zip(camera_names, frames):
+                writer.write(camera_name, 0, frame)
+            break
+
+        frames_small = [cv.resize(frame, None, fx=1./view_resize, fy=1./view_resize) for frame in frames]
+        cv.putText(frames_small[0], "Ensure the cameras have not been moved", (50, 50), cv.FONT_HERSHEY_COMPLEX, 1, (0, 0, 255), 1)
+        cv.putText(frames_small[0], "Press SPACEBAR to capture the frame", (50, 100), cv.FONT_HERSHEY_COMPLEX, 1, (0, 0, 255), 1)
+        k = show_preview(*frames_small)
+
+        if k == 27:  # ESC key
+            capture.release()
+            writer.close()
+            quit()
+
+        if k == 32:  # Spacebar
+            start = True
+
+    capture.release()
+    writer.close()
+    if not calibration_settings['headless']:
+        cv.destroyAllWindows()
 
 def parse_settings_file():
     # Parse the calibration settings file
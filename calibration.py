@@ -1,28 +1,373 @@
 import cv2 as cv
-import glob
+import hashlib
+import json
 import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from frame_store import StoredFrame, open_frame_store
+from reprojection import residual_report, rotation_matrices, view_errors, view_residuals
+import instrumentation
 
-# Clear the console screen
-os.system('cls' if os.name == 'nt' else 'clear')
+# Checkerboard dimensions (inner corners)
+checkerboard_rows = 4
+checkerboard_columns = 5
 
-def calibrate_camera(images):
+# Criteria used to refine the detected corners (shared by every calibration so detections can be cached)
+subpix_criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 100, 0.0001)
+
+# Checkerboard detection engines:
+#   full: findChessboardCorners on the full resolution image, then cornerSubPix
+#   pyramid: findChessboardCorners with the fast check on a pyramid-reduced image, then cornerSubPix at full resolution
+#   sb: findChessboardCornersSB (sector based, already sub-pixel accurate)
+detection_engines = ('full', 'pyramid', 'sb')
+
+# The pyramid engine halves the image until its width is at most this value
+pyramid_max_width = 960
+pyramid_flags = cv.CALIB_CB_ADAPTIVE_THRESH + cv.CALIB_CB_NORMALIZE_IMAGE + cv.CALIB_CB_FAST_CHECK
+
+# Cells per image side of the grid used to measure how much of the image the selected boards cover
+coverage_grid_size = 6
+
+def file_hash(path):
+    """
+    Returns the SHA-1 hex digest of a file's content.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def frame_hash(frame):
+    """
+    Returns the SHA-1 hex digest of an image file or of the pixels of a stored frame.
+    The digest of a stored frame is read from the store index, the pixels are only hashed for older stores.
+    """
+    if isinstance(frame, StoredFrame):
+        store = open_frame_store(frame.foldername)
+        if store.digest is not None:
+            return str(store.digest[frame.index])
+        return hashlib.sha1(np.ascontiguousarray(store.image(frame.index))).hexdigest()
+    return file_hash(frame)
+
+def frame_folder(frame):
+    """
+    Returns the folder holding an image file or a stored frame (where its detection cache lives).
+    """
+    if isinstance(frame, StoredFrame):
+        return frame.foldername
+    return os.path.dirname(frame)
+
+def load_gray(frame):
+    """
+    Returns an image file or a stored frame in grayscale. Stored frames are read without decoding.
+    """
+    if isinstance(frame, StoredFrame):
+        return open_frame_store(frame.foldername).gray(frame.index)
+    return cv.cvtColor(cv.imread(frame), cv.COLOR_BGR2GRAY)
+
+def detection_cache_path(foldername, rows, columns, engine):
+    """
+    Returns the path of the detection cache of a frame folder for a given checkerboard size and detection engine.
+    """
+    return os.path.join(foldername, f'.chessboard_cache_{engine}_{rows}x{columns}.npz')
+
+def load_detection_cache(foldername, rows, columns, engine):
+    """
+    Loads the detection cache of a frame folder.
+
+    Returns:
+        cache (dict): Maps a frame content hash to (found, corners, (height, width)).
+            Failed detections are stored with corners set to None.
+    """
+    path = detection_cache_path(foldername, rows, columns, engine)
+    cache = {}
+    if not os.path.exists(path):
+        return cache
+
+    with np.load(path, allow_pickle=False) as data:
+        for key, found, corners, shape in zip(data['hashes'], data['found'], data['corners'], data['shapes']):
+            cache[str(key)] = (bool(found), corners if found else None, tuple(int(v) for v in shape))
+    return cache
+
+def save_detection_cache(foldername, rows, columns, engine, cache):
+    """
+    Writes the detection cache of a frame folder (see load_detection_cache).
+    """
+    keys = list(cache.keys())
+    corners = np.full((len(keys), rows * columns, 1, 2), np.nan, np.float32)
+    for i, key in enumerate(keys):
+        if cache[key][0]:
+            corners[i] = np.reshape(cache[key][1], (-1, 1, 2))
+
+    # Write next to the final file first so an interrupted run never leaves a corrupted cache
+    path = detection_cache_path(foldername, rows, columns, engine)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path,
+             hashes=np.array(keys, dtype=str),
+             found=np.array([cache[key][0] for key in keys], dtype=bool),
+             corners=corners,
+             shapes=np.array([cache[key][2] for key in keys], dtype=np.int64).reshape(-1, 2))
+    os.replace(tmp_path, path)
+
+def search_chessboard(gray, rows, columns, engine):
+    """
+    Finds the checkerboard corners of a grayscale image with the chosen engine, without refinement
+    (the sb engine is already sub-pixel accurate).
+    """
+    if engine == 'sb':
+        return cv.findChessboardCornersSB(gray, (rows, columns), None)
+
+    if engine == 'pyramid':
+        # Search on a reduced image: the fast check rejects frames without a board almost immediately
+        small = gray
+        scale = 1
+        while small.shape[1] > pyramid_max_width:
+            small = cv.pyrDown(small)
+            scale *= 2
+        ret, corners = cv.findChessboardCorners(small, (rows, columns), None, pyramid_flags)
+
+        if ret:
+            # Back to full resolution pixel coordinates (pyrDown keeps the pixel (2x, 2y) at (x, y))
+            return ret, corners * scale
+        if scale > 1:
+            # Small boards can vanish in the reduced image, retry at full resolution
+            return cv.findChessboardCorners(gray, (rows, columns), None, pyramid_flags)
+        return ret, corners
+
+    if engine == 'full':
+        return cv.findChessboardCorners(gray, (rows, columns), None)
+
+    raise ValueError(f'Unknown detection engine: {engine}')
+
+def find_chessboard(gray, rows, columns, engine='pyramid'):
+    """
+    Finds the checkerboard corners with sub-pixel accuracy in a grayscale image.
+
+    Parameters:
+        gray (numpy.ndarray): Grayscale image.
+        rows, columns (int): Checkerboard dimensions (inner corners).
+        engine (str): One of detection_engines.
+
+    Returns:
+        ret (bool): True if the checkerboard was found.
+        corners (numpy.ndarray): (rows*columns, 1, 2) refined corners, or None if not found.
+    """
+    with instrumentation.timer('detection.find'):
+        ret, corners = search_chessboard(gray, rows, columns, engine)
+
+    if not ret:
+        instrumentation.count('detection.failures')
+        return False, None
+
+    if engine == 'sb':
+        return True, corners.reshape(-1, 1, 2)
+
+    # Refine corner detection at full resolution
+    with instrumentation.timer('detection.subpix'):
+        corners = cv.cornerSubPix(gray, corners.reshape(-1, 1, 2).astype(np.float32), (11, 11), (-1, -1), subpix_criteria)
+    return True, corners
+
+def detect_chessboard(frame, rows, columns, engine='pyramid'):
+    """
+    Finds and refines the checkerboard corners in one image (file path or StoredFrame).
+
+    Returns:
+        ret (bool): True if the checkerboard was found.
+        corners (numpy.ndarray): Refined corners, or None if not found.
+        shape (tuple): (height, width) of the image.
+    """
+    gray = load_gray(frame)
+    ret, corners = find_chessboard(gray, rows, columns, engine)
+    return ret, corners, gray.shape
+
+def init_detection_worker():
+    # Each worker handles one frame at a time, so OpenCV's own thread pool would only oversubscribe the cores
+    cv.setNumThreads(1)
+
+def detect_chessboards(images, rows, columns, workers=None, engine='pyramid'):
+    """
+    Detects the checkerboard in a list of images, using the on-disk cache of each frame folder.
+    Only new or changed frames (by content hash) are decoded and searched, in parallel across processes.
+
+    Parameters:
+        images (list): List of image file paths or StoredFrame references.
+        rows, columns (int): Checkerboard dimensions (inner corners).
+        workers (int): Number of detection processes. None or 0 uses all CPU cores, 1 detects serially.
+        engine (str): Checkerboard detection engine (see detection_engines).
+
+    Returns:
+        detections (list): (ret, corners, (height, width)) for each image, in the same order.
+    """
+    caches = {}
+    keys = []
+    missing = {}  # (folder, content hash) -> frame that still needs a detection
+
+    for frame in images:
+        foldername = frame_folder(frame)
+        if foldername not in caches:
+            caches[foldername] = load_detection_cache(foldername, rows, columns, engine)
+
+        with instrumentation.timer('detection.hash'):
+            key = frame_hash(frame)
+        keys.append((foldername, key))
+        if key not in caches[foldername] and (foldername, key) not in missing:
+            missing[(foldername, key)] = frame
+
+    instrumentation.count('detection.cache_hits', len(images) - len(missing))
+    instrumentation.count('detection.cache_misses', len(missing))
+
+    if not workers:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(missing))
+
+    # Per-frame timers and counters of the worker processes are not collected, only the whole batch
+    frames = list(missing.values())
+    with instrumentation.timer('detection.batch'):
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_detection_worker) as executor:
+                # map() yields results in submission order, so the output order does not depend on scheduling
+                results = list(executor.map(detect_chessboard, frames, repeat(rows), repeat(columns), repeat(engine)))
+        else:
+            results = [detect_chessboard(frame, rows, columns, engine) for frame in frames]
+
+    dirty = set()
+    for (foldername, key), result in zip(missing.keys(), results):
+        caches[foldername][key] = result
+        dirty.add(foldername)
+
+    for foldername in dirty:
+        save_detection_cache(foldername, rows, columns, engine, caches[foldername])
+
+    return [caches[foldername][key] for foldername, key in keys]
+
+def board_features(corners, image_size):
+    """
+    Describes where and how a board was seen: center (normalized image coordinates), scale and tilt.
+
+    Parameters:
+        corners (numpy.ndarray): Detected corners of one view.
+        image_size (tuple): (width, height) of the image.
+
+    Returns:
+        features (numpy.ndarray): [center x, center y, scale, horizontal tilt, vertical tilt]. The tilts are
+            log ratios of opposite board sides (0 for a board facing the camera).
+    """
+    width, height = image_size
+    grid = np.reshape(corners, (checkerboard_columns, checkerboard_rows, 2))
+    quad = np.array([grid[0, 0], grid[0, -1], grid[-1, -1], grid[-1, 0]], np.float32)
+    side = lambda a, b: np.linalg.norm(quad[a] - quad[b])
+
+    center = quad.mean(axis=0) / [width, height]
+    scale = np.sqrt(cv.contourArea(quad) / (width * height))
+    return np.array([center[0], center[1], scale, np.log(side(0, 3) / side(1, 2)), np.log(side(0, 1) / side(3, 2))])
+
+def coverage_cells(corners, image_size, grid_size=coverage_grid_size):
+    """
+    Returns the set of cells of a grid_size x grid_size image grid that contain corners.
+    """
+    cells = np.floor(np.reshape(corners, (-1, 2)) / image_size * grid_size).astype(int)
+    cells = np.clip(cells, 0, grid_size - 1)
+    return set(map(tuple, cells))
+
+def select_diverse_frames(views, image_size, count):
+    """
+    Greedily picks a compact subset of frames with boards spread over the images and varied in scale and tilt.
+
+    The first pick is the largest board. Each next pick is the frame farthest (in normalized board features)
+    from every frame already picked, plus a bonus for the image cells it adds to the covered area.
+
+    Parameters:
+        views (list): For each camera, the list of detected corners of every frame (same frames for all cameras).
+        image_size (tuple): (width, height) of the images.
+        count (int): Number of frames to keep.
+
+    Returns:
+        selected (list): Sorted indices of the picked frames.
+    """
+    frame_count = len(views[0])
+    if frame_count <= count:
+        return list(range(frame_count))
+
+    features = np.array([np.concatenate([board_features(view[i], image_size) for view in views]) for i in range(frame_count)])
+    spread = features.std(axis=0)
+    features = (features - features.mean(axis=0)) / np.where(spread > 0, spread, 1)
+    cells = [set((camera, cell) for camera, view in enumerate(views) for cell in coverage_cells(view[i], image_size))
+             for i in range(frame_count)]
+    cell_total = coverage_grid_size ** 2 * len(views)
+
+    scales = features[:, 2::5].sum(axis=1)
+    selected = [int(np.argmax(scales))]
+    covered = set(cells[selected[0]])
+    distance = np.linalg.norm(features - features[selected[0]], axis=1)
+
+    while len(selected) < count:
+        gain = distance + np.array([len(c - covered) for c in cells]) / cell_total * features.shape[1]
+        gain[selected] = -np.inf
+        best = int(np.argmax(gain))
+        selected.append(best)
+        covered |= cells[best]
+        distance = np.minimum(distance, np.linalg.norm(features - features[best], axis=1))
+
+    return sorted(selected)
+
+def reprojection_errors(objpoints, imgpoints, rvecs, tvecs, mtx, dist):
+    """
+    Returns the RMS reprojection error of every calibration view.
+    """
+    residuals, view_ids = view_residuals(objpoints, imgpoints, rvecs, tvecs, mtx, dist)
+    return view_errors(residuals, view_ids, len(objpoints))
+
+def stereo_pair_errors(objpoints, imgpoints_left, imgpoints_right, mtx1, dist1, mtx2, dist2, R, T):
+    """
+    Returns the RMS reprojection error of every stereo pair: the board pose is estimated in the first camera
+    and transferred to the second one with R, T.
+    """
+    poses = [cv.solvePnP(objp, corners1, mtx1, dist1)[1:] for objp, corners1 in zip(objpoints, imgpoints_left)]
+    rvecs1 = [rvec for rvec, tvec in poses]
+    tvecs1 = np.reshape([tvec for rvec, tvec in poses], (-1, 3))
+
+    # Board poses in the second camera, then both cameras projected in one batch each
+    Rs2 = R @ rotation_matrices(rvecs1)
+    tvecs2 = tvecs1 @ np.transpose(R) + np.ravel(T)
+    residuals1, view_ids = view_residuals(objpoints, imgpoints_left, rvecs1, tvecs1, mtx1, dist1)
+    residuals2, _ = view_residuals(objpoints, imgpoints_right, Rs2, tvecs2, mtx2, dist2)
+    return view_errors(np.concatenate([residuals1, residuals2]), np.concatenate([view_ids, view_ids]), len(objpoints))
+
+def worst_outlier(errors, factor=2.0, min_frames=5):
+    """
+    Returns the index of the view with the highest error if it is above factor times the median error
+    (and enough views would remain), otherwise None.
+    """
+    if len(errors) <= min_frames:
+        return None
+    worst = int(np.argmax(errors))
+    return worst if errors[worst] > factor * np.median(errors) else None
+
+def calibrate_camera(images, workers=None, engine='pyramid', max_frames=None, rejection_rounds=0, report=False):
     """
     Calibrates a single camera using a set of images.
 
     Parameters:
-        images (list): List of image file paths.
+        images (list): List of image file paths or StoredFrame references.
+        workers (int): Number of checkerboard detection processes (None uses all CPU cores).
+        engine (str): Checkerboard detection engine (see detection_engines).
+        max_frames (int): If more boards are detected, only the most diverse max_frames are solved (see select_diverse_frames).
+        rejection_rounds (int): Maximum number of recalibrations, each dropping the view with the highest
+            reprojection error if it is an outlier.
+        report (bool): Also return the reprojection analytics of the solved views.
 
     Returns:
         mtx (numpy.ndarray): Camera matrix.
         dist (numpy.ndarray): Distortion coefficients.
+        ret (float): Calibration RMSE.
+        report (dict): Only if 'report' is set: reprojection.residual_report of the views solved last, with
+            'frames' holding their indices in 'images'.
     """
-    # Criteria used by the checkerboard pattern detector
-    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-
     # Checkerboard dimensions (inner corners)
-    rows = 4
-    columns = 5
+    rows = checkerboard_rows
+    columns = checkerboard_columns
     world_scaling = 1  # Real-world square size scaling factor
 
     # Coordinates of squares in the checkerboard world space
@@ -33,54 +378,118 @@ def calibrate_camera(images):
     # Lists to store object points and image points
     objpoints = []  # 3D points in real-world space
     imgpoints = []  # 2D points in image plane
+    frames = []  # Index of each view in images
 
     # Frame dimensions (assume all images are the same size)
     width = None
     height = None
 
-    for frame_path in images:
-        frame = cv.imread(frame_path)
-        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-
-        # Find the checkerboard
-        ret, corners = cv.findChessboardCorners(gray, (rows, columns), None)
-
+    for index, (ret, corners, shape) in enumerate(detect_chessboards(images, rows, columns, workers, engine)):
         if ret:
-            # Refine corner detection
-            corners = cv.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
             objpoints.append(objp)
             imgpoints.append(corners)
+            frames.append(index)
 
             # Set frame dimensions
             if width is None or height is None:
-                height, width = gray.shape
+                height, width = shape
+
+    # Keep only a diverse subset of the frames for the solver
+    if max_frames and len(imgpoints) > max_frames:
+        selected = select_diverse_frames([imgpoints], (width, height), max_frames)
+        objpoints = [objpoints[i] for i in selected]
+        imgpoints = [imgpoints[i] for i in selected]
+        frames = [frames[i] for i in selected]
+
+    # Perform camera calibration, dropping the worst view and recalibrating while it is an outlier
+    for attempt in range(rejection_rounds + 1):
+        with instrumentation.timer('calibrateCamera'):
+            ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, (width, height), None, None)
+        if attempt == rejection_rounds:
+            break
 
-    # Perform camera calibration
-    ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, (width, height), None, None)
+        worst = worst_outlier(reprojection_errors(objpoints, imgpoints, rvecs, tvecs, mtx, dist))
+        if worst is None:
+            break
+        del objpoints[worst], imgpoints[worst], frames[worst]
+
+    if report:
+        analytics = residual_report(objpoints, imgpoints, rvecs, tvecs, mtx, dist)
+        analytics['frames'] = np.array(frames)
+        return mtx, dist, ret, analytics
     return mtx, dist, ret
 
 
-def stereo_calibrate(mtx1, dist1, mtx2, dist2, images_camera0, images_camera1):
+def stereo_detections(images_camera0, images_camera1, workers=None, engine='pyramid'):
+    """
+    Detects the checkerboard in pairs of images and keeps the pairs where it is found in both.
+
+    Parameters:
+        images_camera0 (list): List of image file paths or StoredFrame references for the first camera.
+        images_camera1 (list): List of image file paths or StoredFrame references for the second camera.
+        workers (int): Number of checkerboard detection processes (None uses all CPU cores).
+        engine (str): Checkerboard detection engine (see detection_engines).
+
+    Returns:
+        imgpoints_left (list): Corners of every kept pair in the first camera.
+        imgpoints_right (list): Corners of every kept pair in the second camera.
+        image_size (tuple): (width, height) of the images, (None, None) if no pair was kept.
+    """
+    imgpoints_left = []  # 2D points in image plane for the first camera
+    imgpoints_right = []  # 2D points in image plane for the second camera
+
+    # Frame dimensions (assume all images are the same size)
+    width = None
+    height = None
+
+    # Detections are shared with calibrate_camera through the cache
+    # Both cameras are detected in one batch so the process pool is shared by all frames
+    detections = detect_chessboards(list(images_camera0) + list(images_camera1), checkerboard_rows, checkerboard_columns,
+                                    workers, engine)
+    detections0 = detections[:len(images_camera0)]
+    detections1 = detections[len(images_camera0):]
+
+    for (ret1, corners1, shape1), (ret2, corners2, shape2) in zip(detections0, detections1):
+        if ret1 and ret2:
+            imgpoints_left.append(corners1)
+            imgpoints_right.append(corners2)
+
+            # Set frame dimensions
+            if width is None or height is None:
+                height, width = shape1
+
+    return imgpoints_left, imgpoints_right, (width, height)
+
+
+def stereo_calibrate(mtx1, dist1, mtx2, dist2, images_camera0, images_camera1, workers=None, engine='pyramid',
+                     max_frames=None, rejection_rounds=0):
     """
     Performs stereo calibration using two sets of images.
 
     Parameters:
         mtx1, dist1: Camera matrix and distortion coefficients for the first camera.
         mtx2, dist2: Camera matrix and distortion coefficients for the second camera.
-        images_camera0 (list): List of image file paths for the first camera.
-        images_camera1 (list): List of image file paths for the second camera.
+        images_camera0 (list): List of image file paths or StoredFrame references for the first camera.
+        images_camera1 (list): List of image file paths or StoredFrame references for the second camera.
+        workers (int): Number of checkerboard detection processes (None uses all CPU cores).
+        engine (str): Checkerboard detection engine (see detection_engines).
+        max_frames (int): If more pairs are detected, only the most diverse max_frames are solved.
+        rejection_rounds (int): Maximum number of recalibrations, each dropping the pair with the highest
+            reprojection error if it is an outlier.
 
     Returns:
         R (numpy.ndarray): Rotation matrix.
         T (numpy.ndarray): Translation vector.
         ret (float): Stereo calibration RMSE.
+        E (numpy.ndarray): Essential matrix.
+        F (numpy.ndarray): Fundamental matrix.
     """
     # Criteria for stereo calibration
     criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 100, 0.0001)
 
     # Checkerboard dimensions (inner corners)
-    rows = 4
-    columns = 5
+    rows = checkerboard_rows
+    columns = checkerboard_columns
     world_scaling = 1.0
 
     # Coordinates of squares in the checkerboard world space
@@ -88,44 +497,289 @@ def stereo_calibrate(mtx1, dist1, mtx2, dist2, images_camera0, images_camera1):
     objp[:, :2] = np.mgrid[0:rows, 0:columns].T.reshape(-1, 2)
     objp = world_scaling * objp
 
-    # Lists to store object points and image points
-    objpoints = []  # 3D points in real-world space
-    imgpoints_left = []  # 2D points in image plane for the first camera
-    imgpoints_right = []  # 2D points in image plane for the second camera
+    # Find the checkerboard in both images
+    imgpoints_left, imgpoints_right, (width, height) = stereo_detections(images_camera0, images_camera1, workers, engine)
+    objpoints = [objp] * len(imgpoints_left)  # 3D points in real-world space
 
-    # Frame dimensions (assume all images are the same size)
-    width = None
-    height = None
+    # Keep only a diverse subset of the pairs for the solver
+    if max_frames and len(objpoints) > max_frames:
+        selected = select_diverse_frames([imgpoints_left, imgpoints_right], (width, height), max_frames)
+        objpoints = [objpoints[i] for i in selected]
+        imgpoints_left = [imgpoints_left[i] for i in selected]
+        imgpoints_right = [imgpoints_right[i] for i in selected]
 
-    for frame1_path, frame2_path in zip(images_camera0, images_camera1):
-        frame1 = cv.imread(frame1_path)
-        frame2 = cv.imread(frame2_path)
+    # Perform stereo calibration, dropping the worst pair and recalibrating while it is an outlier
+    stereocalibration_flags = cv.CALIB_FIX_INTRINSIC
+    for attempt in range(rejection_rounds + 1):
+        with instrumentation.timer('stereoCalibrate'):
+            ret, CM1, dist1, CM2, dist2, R, T, E, F = cv.stereoCalibrate(
+                objpoints, imgpoints_left, imgpoints_right, mtx1, dist1, mtx2, dist2,
+                (width, height), criteria=criteria, flags=stereocalibration_flags
+            )
+        if attempt == rejection_rounds:
+            break
 
-        gray1 = cv.cvtColor(frame1, cv.COLOR_BGR2GRAY)
-        gray2 = cv.cvtColor(frame2, cv.COLOR_BGR2GRAY)
+        worst = worst_outlier(stereo_pair_errors(objpoints, imgpoints_left, imgpoints_right, mtx1, dist1, mtx2, dist2, R, T))
+        if worst is None:
+            break
+        del objpoints[worst], imgpoints_left[worst], imgpoints_right[worst]
 
-        # Find the checkerboard in both images
-        ret1, corners1 = cv.findChessboardCorners(gray1, (rows, columns), None)
-        ret2, corners2 = cv.findChessboardCorners(gray2, (rows, columns), None)
+    return R, T, ret, E, F
 
-        if ret1 and ret2:
-            # Refine corner detection
-            corners1 = cv.cornerSubPix(gray1, corners1, (11, 11), (-1, -1), criteria)
-            corners2 = cv.cornerSubPix(gray2, corners2, (11, 11), (-1, -1), criteria)
 
-            objpoints.append(objp)
-            imgpoints_left.append(corners1)
-            imgpoints_right.append(corners2)
+def rig_spanning_tree(shared, minimum=1):
+    """
+    Chains the cameras of a rig to the first one through the pairs that saw the most boards together
+    (maximum spanning tree grown from camera 0).
 
-            # Set frame dimensions
-            if width is None or height is None:
-                height, width = gray1.shape
+    Parameters:
+        shared (numpy.ndarray): (C,C) number of frames in which each pair of cameras detected the board.
+        minimum (int): Pairs that shared fewer frames are not used.
 
-    # Perform stereo calibration
-    stereocalibration_flags = cv.CALIB_FIX_INTRINSIC
-    ret, CM1, dist1, CM2, dist2, R, T, E, F = cv.stereoCalibrate(
-        objpoints, imgpoints_left, imgpoints_right, mtx1, dist1, mtx2, dist2,
-        (width, height), criteria=criteria, flags=stereocalibration_flags
-    )
+    Returns:
+        edges (list): (parent, child) camera pairs, each parent linked before its children. Cameras that
+            cannot be linked are missing, so len(edges) == C - 1 when the whole rig is connected.
+    """
+    linked = [0]
+    edges = []
+    while True:
+        candidates = [(shared[parent][child], parent, child) for parent in linked for child in range(len(shared))
+                      if child not in linked and shared[parent][child] >= minimum]
+        if not candidates:
+            return edges
+        _, parent, child = max(candidates)
+        edges.append((parent, child))
+        linked.append(child)
+
+def calibrate_rig(images, workers=None, engine='pyramid', mono_frames=None, stereo_frames=None, rejection_rounds=0,
+                  minimum_shared=3):
+    """
+    Calibrates a rig of any number of cameras into the frame of the first camera.
+
+    Each camera is calibrated individually, then the pairs of the maximum spanning tree of shared detections
+    (see rig_spanning_tree) are stereo calibrated and their R, T are chained from the first camera.
+
+    Parameters:
+        images (list): For each camera, the list of image file paths or StoredFrame references. The i-th
+            image of every camera must have been captured in the same round.
+        workers (int): Number of checkerboard detection processes (None uses all CPU cores).
+        engine (str): Checkerboard detection engine (see detection_engines).
+        mono_frames, stereo_frames (int): Maximum number of frames solved per camera and per pair (see calibrate_camera).
+        rejection_rounds (int): Outlier rejection rounds of every solve.
+        minimum_shared (int): Minimum number of frames in which a pair must see the board to be calibrated.
+
+    Returns:
+        rig (dict): mtx, dist, R, T and rmse stacked per camera (R, T map the first camera's frame to each
+            camera), stereo_rmse of the pair each camera was chained with (0 for the first camera), the
+            chained pairs (edges) and image_size.
+    """
+    camera_count = len(images)
+    frame_count = len(images[0])
+    if any(len(camera_images) != frame_count for camera_images in images):
+        print('Every camera of the rig must have the same number of frames.')
+        quit()
+
+    # All cameras are detected in one batch so the process pool is shared (the solves below hit the cache)
+    detections = detect_chessboards([image for camera_images in images for image in camera_images],
+                                    checkerboard_rows, checkerboard_columns, workers, engine)
+    found = np.array([ret for ret, _, _ in detections], np.int32).reshape(camera_count, frame_count)
+    edges = rig_spanning_tree(found @ found.T, minimum_shared)
+    if len(edges) != camera_count - 1:
+        print('Some cameras never saw the board together with the rest of the rig:', found @ found.T)
+        quit()
+    height, width = next(shape for ret, _, shape in detections if ret)
+
+    mtxs, dists, rmses = [], [], []
+    for camera_images in images:
+        mtx, dist, rmse = calibrate_camera(camera_images, workers, engine, mono_frames, rejection_rounds)
+        mtxs.append(mtx)
+        dists.append(dist)
+        rmses.append(rmse)
+
+    # Chain the pairs: a child camera sees the world through its parent
+    Rs = [np.eye(3)] * camera_count
+    Ts = [np.zeros((3, 1))] * camera_count
+    stereo_rmses = [0.] * camera_count
+    for parent, child in edges:
+        R, T, stereo_rmse, _, _ = stereo_calibrate(mtxs[parent], dists[parent], mtxs[child], dists[child], images[parent],
+                                                   images[child], workers, engine, stereo_frames, rejection_rounds)
+        Rs[child] = R @ Rs[parent]
+        Ts[child] = R @ Ts[parent] + np.reshape(T, (3, 1))
+        stereo_rmses[child] = stereo_rmse
+
+    return {'mtx': np.array(mtxs), 'dist': np.array(dists), 'R': np.array(Rs), 'T': np.array(Ts),
+            'rmse': np.array(rmses), 'stereo_rmse': np.array(stereo_rmses), 'edges': np.array(edges),
+            'image_size': (width, height)}
+
+
+# Version of the calibration file written by save_calibration
+calibration_format_version = 1
+
+# Settings that describe the rig: a calibration is only reused while they are unchanged
+rig_settings = ('cameras', 'camera0', 'camera1', 'frame_width', 'frame_height', 'checkerboard_box_size_scale')
+
+def settings_hash(settings):
+    """
+    Returns a hash of the rig settings and of the checkerboard dimensions used for calibration.
+    """
+    rig = {key: settings.get(key) for key in rig_settings}
+    rig['checkerboard'] = [checkerboard_rows, checkerboard_columns]
+    for camera_name in settings.get('cameras') or []:
+        rig[camera_name] = settings.get(camera_name)
+    return hashlib.sha1(json.dumps(rig, sort_keys=True).encode()).hexdigest()
+
+def save_calibration(filename, calibration):
+    """
+    Saves a stereo calibration to a .npz file.
+
+    Parameters:
+        filename (str): Path of the .npz file.
+        calibration (dict): mtx1, dist1, mtx2, dist2, R, T, E, F, image_size, rmse1, rmse2, stereo_rmse
+            and settings_hash, optionally with the detected corners of every pair (corners1 and corners2)
+            used by recalibrate. Rigs of more than two cameras save the result of calibrate_rig instead.
+    """
+    np.savez(filename, version=calibration_format_version,
+             **{key: np.asarray(value) for key, value in calibration.items()})
+
+def load_calibration(filename, expected_settings_hash=None):
+    """
+    Loads a stereo calibration saved by save_calibration.
+
+    Parameters:
+        filename (str): Path of the .npz file.
+        expected_settings_hash (str): If given, the calibration is only returned if it was made with these settings.
+
+    Returns:
+        calibration (dict): See save_calibration, or None if the file is missing, from another version
+            or made with other settings.
+    """
+    if not os.path.exists(filename):
+        return None
+
+    with np.load(filename, allow_pickle=False) as data:
+        if int(data['version']) != calibration_format_version:
+            return None
+        calibration = {key: data[key] for key in data.files if key != 'version'}
+
+    for key in ('rmse1', 'rmse2', 'stereo_rmse'):
+        if key in calibration and calibration[key].ndim == 0:
+            calibration[key] = float(calibration[key])
+    calibration['settings_hash'] = str(calibration['settings_hash'])
+    calibration['image_size'] = tuple(int(v) for v in calibration['image_size'])
+
+    if expected_settings_hash is not None and calibration['settings_hash'] != expected_settings_hash:
+        return None
+    return calibration
+
+def calibration_drift(previous, current):
+    """
+    Measures how far a calibration moved from a previous one.
+
+    Parameters:
+        previous (dict): Previous calibration (see save_calibration).
+        current (dict): New calibration.
+
+    Returns:
+        drift (dict): focal1/focal2 (change of the focal lengths, in pixels), center1/center2 (shift of the
+            principal points, in pixels), rotation (angle between the two R, in degrees), translation
+            (norm of the T difference, in checkerboard squares) and stereo_rmse (RMSE change).
+    """
+    drift = {}
+    for camera in ('1', '2'):
+        mtx_previous, mtx_current = previous['mtx' + camera], current['mtx' + camera]
+        drift['focal' + camera] = float(np.abs(np.diag(mtx_current)[:2] - np.diag(mtx_previous)[:2]).max())
+        drift['center' + camera] = float(np.linalg.norm(mtx_current[:2, 2] - mtx_previous[:2, 2]))
+
+    rotation, _ = cv.Rodrigues(current['R'] @ previous['R'].T)
+    drift['rotation'] = float(np.degrees(np.linalg.norm(rotation)))
+    drift['translation'] = float(np.linalg.norm(np.ravel(current['T']) - np.ravel(previous['T'])))
+    drift['stereo_rmse'] = current['stereo_rmse'] - previous['stereo_rmse']
+    return drift
+
+def recalibrate(calibration, images_camera0, images_camera1, workers=None, engine='pyramid', max_iterations=30,
+                max_frames=None):
+    """
+    Refines a saved calibration with new frame pairs instead of recalibrating from scratch.
+
+    The new detections are appended to the ones accumulated in the calibration (corners1 and corners2), at
+    most max_frames pairs are kept so every check costs the same, and the solvers start from the saved parameters (CALIB_USE_INTRINSIC_GUESS for each camera, then
+    CALIB_USE_EXTRINSIC_GUESS with the intrinsics fixed for the pair), so they converge in a few iterations.
+
+    Parameters:
+        calibration (dict): Calibration loaded by load_calibration.
+        images_camera0 (list): New image file paths or StoredFrame references for the first camera.
+        images_camera1 (list): New image file paths or StoredFrame references for the second camera.
+        workers (int): Number of checkerboard detection processes (None uses all CPU cores).
+        engine (str): Checkerboard detection engine (see detection_engines).
+        max_iterations (int): Maximum number of solver iterations.
+        max_frames (int): Maximum number of accumulated pairs kept and solved: every new pair, completed with
+            the most diverse previous pairs (see select_diverse_frames). None keeps them all.
+
+    Returns:
+        calibration (dict): Refined calibration, with the new detections appended.
+        drift (dict): How far the parameters moved (see calibration_drift).
+    """
+    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, max_iterations, 0.0001)
+
+    # Coordinates of squares in the checkerboard world space
+    objp = np.zeros((checkerboard_rows * checkerboard_columns, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:checkerboard_rows, 0:checkerboard_columns].T.reshape(-1, 2)
+
+    # Accumulated detections followed by the new ones
+    corner_shape = (-1, checkerboard_rows * checkerboard_columns, 1, 2)
+    imgpoints_left, imgpoints_right, image_size = stereo_detections(images_camera0, images_camera1, workers, engine)
+    if image_size[0] is not None and tuple(image_size) != tuple(calibration['image_size']):
+        print('The new frames do not have the calibrated image size:', image_size)
+        quit()
+    previous1 = np.reshape(calibration.get('corners1', []), corner_shape)
+    previous2 = np.reshape(calibration.get('corners2', []), corner_shape)
+    new1 = np.reshape(imgpoints_left, corner_shape)
+    new2 = np.reshape(imgpoints_right, corner_shape)
+    image_size = tuple(calibration['image_size'])
+
+    # Bounded set: the new pairs are always solved (they carry the drift), the rest of the budget goes to
+    # the most diverse previous pairs
+    if max_frames and len(previous1) + len(new1) > max_frames:
+        if len(new1) >= max_frames:
+            selected = select_diverse_frames([new1, new2], image_size, max_frames)
+            new1, new2 = new1[selected], new2[selected]
+            previous1, previous2 = previous1[:0], previous2[:0]
+        else:
+            selected = select_diverse_frames([previous1, previous2], image_size, max_frames - len(new1))
+            previous1, previous2 = previous1[selected], previous2[selected]
+    corners1 = np.concatenate([previous1, new1]).astype(np.float32)
+    corners2 = np.concatenate([previous2, new2]).astype(np.float32)
+    objpoints = [objp] * len(corners1)
+
+    # Each camera, starting from its saved intrinsics
+    with instrumentation.timer('recalibrate.calibrateCamera'):
+        rmse1, mtx1, dist1, _, _ = cv.calibrateCamera(objpoints, list(corners1), image_size, calibration['mtx1'].copy(),
+                                                      calibration['dist1'].copy(), flags=cv.CALIB_USE_INTRINSIC_GUESS,
+                                                      criteria=criteria)
+        rmse2, mtx2, dist2, _, _ = cv.calibrateCamera(objpoints, list(corners2), image_size, calibration['mtx2'].copy(),
+                                                      calibration['dist2'].copy(), flags=cv.CALIB_USE_INTRINSIC_GUESS,
+                                                      criteria=criteria)
+
+    # The pair, starting from the saved rotation and translation
+    # (OpenCV 5 rejects CALIB_USE_EXTRINSIC_GUESS in stereoCalibrate, the pair is then solved without the guess)
+    with instrumentation.timer('recalibrate.stereoCalibrate'):
+        try:
+            stereo_rmse, _, _, _, _, R, T, E, F = cv.stereoCalibrate(
+                objpoints, list(corners1), list(corners2), mtx1, dist1, mtx2, dist2, image_size,
+                calibration['R'].copy(), calibration['T'].copy(), criteria=criteria,
+                flags=cv.CALIB_FIX_INTRINSIC + cv.CALIB_USE_EXTRINSIC_GUESS
+            )
+        except cv.error as error:
+            if error.code != cv.Error.StsBadFlag:
+                raise
+            print('This OpenCV version does not support CALIB_USE_EXTRINSIC_GUESS in stereoCalibrate, '
+                  'the pair is solved without the saved rotation and translation.')
+            instrumentation.count('recalibrate.extrinsic_guess_unsupported')
+            stereo_rmse, _, _, _, _, R, T, E, F = cv.stereoCalibrate(
+                objpoints, list(corners1), list(corners2), mtx1, dist1, mtx2, dist2, image_size,
+                criteria=criteria, flags=cv.CALIB_FIX_INTRINSIC
+            )
 
-    return R, T, ret
+    refined = dict(calibration, mtx1=mtx1, dist1=dist1, mtx2=mtx2, dist2=dist2, R=R, T=T, E=E, F=F,
+                   rmse1=rmse1, rmse2=rmse2, stereo_rmse=stereo_rmse, corners1=corners1, corners2=corners2)
+    return refined, calibration_drift(calibration, refined)
@@ -0,0 +1,186 @@
+import json
+import os
+import time
+from collections import namedtuple
+import cv2 as cv
+
+# Capture mode of a camera: pixel format (FOURCC), resolution, frame rate and driver buffer size
+CaptureProfile = namedtuple('CaptureProfile', ['fourcc', 'width', 'height', 'fps', 'buffer_size'])
+
+# Pixel formats probed by default: MJPG is compressed on the camera (high frame rates over USB 2),
+# YUYV is uncompressed (no decoding, but limited to a few FPS at 1080p on most UVC cameras)
+probed_fourccs = ('MJPG', 'YUYV')
+
+def fourcc_name(value):
+    """
+    Returns the four characters of a CAP_PROP_FOURCC value ('' if the backend does not report it).
+    """
+    value = int(value)
+    if value <= 0:
+        return ''
+    return ''.join(chr((value >> (8 * i)) & 0xFF) for i in range(4))
+
+def apply_profile(cap, profile):
+    """
+    Requests a capture profile and returns the profile the driver actually granted.
+
+    FOURCC is set first: on most backends the available resolutions and frame rates depend on the format.
+    """
+    cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*profile.fourcc))
+    cap.set(cv.CAP_PROP_FRAME_WIDTH, profile.width)
+    cap.set(cv.CAP_PROP_FRAME_HEIGHT, profile.height)
+    if profile.fps:
+        cap.set(cv.CAP_PROP_FPS, profile.fps)
+    if profile.buffer_size:
+        cap.set(cv.CAP_PROP_BUFFERSIZE, profile.buffer_size)
+
+    # Properties the backend does not report (0 or -1) are assumed to be granted
+    fps = cap.get(cv.CAP_PROP_FPS)
+    buffer_size = int(cap.get(cv.CAP_PROP_BUFFERSIZE))
+    return CaptureProfile(fourcc_name(cap.get(cv.CAP_PROP_FOURCC)) or profile.fourcc,
+                          int(cap.get(cv.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv.CAP_PROP_FRAME_HEIGHT)),
+                          fps if fps > 0 else profile.fps, buffer_size if buffer_size > 0 else profile.buffer_size)
+
+def profile_differences(requested, granted):
+    """
+    Returns the fields of a granted profile that differ from the request, as 'field: requested -> granted'.
+    """
+    differences = []
+    for field in ('fourcc', 'width', 'height', 'fps', 'buffer_size'):
+        wanted, got = getattr(requested, field), getattr(granted, field)
+        if not wanted:
+            continue
+        if (field == 'fps' and abs(got - wanted) > 0.5) or (field != 'fps' and got != wanted):
+            differences.append(f'{field}: {wanted} -> {got}')
+    return differences
+
+def measure_profile(cap, frames=30, warmup=5):
+    """
+    Measures the real throughput of an opened camera.
+
+    Parameters:
+        cap (cv.VideoCapture): Camera with the profile applied.
+        frames (int): Number of timed frames.
+        warmup (int): Frames read and discarded first (exposure settling, buffered frames).
+
+    Returns:
+        fps (float): Frames read per second (0 if the camera returned no frames).
+        read_ms (float): Mean duration of a read() call, in milliseconds.
+    """
+    for _ in range(warmup):
+        if not cap.read()[0]:
+            return 0.0, 0.0
+
+    durations = []
+    start = time.perf_counter()
+    for _ in range(frames):
+        read_start = time.perf_counter()
+        ret, _ = cap.read()
+        if not ret:
+            return 0.0, 0.0
+        durations.append(time.perf_counter() - read_start)
+    elapsed = time.perf_counter() - start
+    return frames / elapsed, 1000 * sum(durations) / len(durations)
+
+def candidate_profiles(width, height, target_fps, buffer_size=1):
+    """
+    Profiles probed for a resolution: every probed FOURCC at the target frame rate and at 30 and 60 FPS.
+    """
+    rates = sorted({target_fps, 30, 60}, reverse=True)
+    return [CaptureProfile(fourcc, width, height, fps, buffer_size) for fourcc in probed_fourccs for fps in rates]
+
+def probe_device(device, candidates, frames=30):
+    """
+    Opens a camera with every candidate profile and measures what the driver granted and how fast it runs.
+
+    Returns:
+        results (list): Dictionaries with the requested and granted profiles, fps and read_ms of each candidate.
+    """
+    results = []
+    for profile in candidates:
+        cap = cv.VideoCapture(device)
+        if not cap.isOpened():
+            print('Could not open camera:', device)
+            quit()
+        granted = apply_profile(cap, profile)
+        fps, read_ms = measure_profile(cap, frames)
+        cap.release()
+
+        print(f'  {profile.fourcc} {profile.width}x{profile.height}@{profile.fps}: granted {granted.fourcc} '
+              f'{granted.width}x{granted.height}@{granted.fps:g}, measured {fps:.1f} FPS, read {read_ms:.1f} ms')
+        results.append({'requested': profile._asdict(), 'granted': granted._asdict(), 'fps': fps, 'read_ms': read_ms})
+    return results
+
+def select_profile(results, width, height, target_fps):
+    """
+    Picks the best probed profile: among the modes granted at the requested resolution, the one with the
+    lowest read latency that reaches the target frame rate, otherwise the fastest one.
+
+    Returns:
+        result (dict): The selected probe result, or None if no mode gave frames at the requested resolution.
+    """
+    usable = [result for result in results if result['fps'] > 0 and
+              (result['granted']['width'], result['granted']['height']) == (width, height)]
+    if not usable:
+        return None
+    meeting = [result for result in usable if result['fps'] >= 0.9 * target_fps]
+    if meeting:
+        return min(meeting, key=lambda result: result['read_ms'])
+    return max(usable, key=lambda result: result['fps'])
+
+def profile_cache_key(device, width, height, target_fps):
+    return f'{device}:{width}x{height}@{target_fps}'
+
+def load_cached_profile(filename, key):
+    """
+    Returns the profile cached for a device and request key, or None.
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        entry = json.load(f).get(key)
+    return CaptureProfile(**entry['profile']) if entry else None
+
+def save_cached_profile(filename, key, result):
+    cache = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            cache = json.load(f)
+    cache[key] = result
+    with open(filename, 'w') as f:
+        json.dump(cache, f, indent=2)
+
+def autotune_profile(device, width, height, target_fps, buffer_size=1, cache_file=None, frames=30):
+    """
+    Returns the best capture profile of a camera for a resolution and target frame rate, probed once and
+    then read from 'cache_file'.
+
+    Parameters:
+        device (int or str): OpenCV camera index or device path.
+        width, height (int): Requested resolution (never traded for frame rate, it is part of the calibration).
+        target_fps (float): Frame rate the capture should reach.
+        buffer_size (int): Driver buffer size (1 keeps the latest frame, lowest latency).
+        cache_file (str): JSON file of the probed profiles (None disables the cache).
+        frames (int): Number of timed frames per probed mode.
+    """
+    key = profile_cache_key(device, width, height, target_fps)
+    if cache_file:
+        profile = load_cached_profile(cache_file, key)
+        if profile is not None:
+            return profile
+
+    print(f'Probing the capture modes of camera {device}...')
+    results = probe_device(device, candidate_profiles(width, height, target_fps, buffer_size), frames)
+    best = select_profile(results, width, height, target_fps)
+    if best is None:
+        print(f'Warning: camera {device} did not grant {width}x{height} in any probed mode.')
+        return CaptureProfile(probed_fourccs[0], width, height, target_fps, buffer_size)
+
+    if best['fps'] < 0.9 * target_fps:
+        print(f'Warning: camera {device} reaches at most {best["fps"]:.1f} FPS at {width}x{height} (target {target_fps}).')
+
+    # The mode the driver granted is requested from now on, so opening the camera does not warn about it
+    profile = CaptureProfile(**best['granted'])
+    if cache_file:
+        save_cached_profile(cache_file, key, dict(best, profile=profile._asdict()))
+    return profile
@@ -35,7 +35,14 @@ def click_recognize(img_path):
 		cv.setMouseCallback('image', click_event, img) 
 
 		# wait for a key to be pressed to exit 
-		if cv.waitKey(0):
+		# (S skips a point hidden in this image: it is recorded as NaN so the next click keeps its place in the order)
+		key = cv.waitKey(0)
+		if key in (ord('s'), ord('S')):
+			print('skipped')
+			coordX.append(float('nan'))
+			coordY.append(float('nan'))
+			continue
+		if key:
 			break
 
 		# close the window 
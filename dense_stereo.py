@@ -0,0 +1,201 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2 as cv
+import numpy as np
+from rectification import rectify_pair
+from triangulation import LatencyStats
+import instrumentation
+
+# Point cloud record: position (checkerboard squares, first rectified camera frame) and color
+point_dtype = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+class DenseStereo:
+    """
+    Dense depth of rectified pairs: StereoSGBM disparity at a pyramid level, reprojected to a point cloud with Q.
+
+    The image is split in horizontal bands that are matched in parallel on a thread pool (OpenCV releases
+    the GIL), each band with its own matcher. Bands overlap by 'overlap' rows so the block window and the
+    vertical aggregation paths see the same neighbourhood as a full image match, the overlap is cropped
+    when the bands are put back together.
+    """
+
+    def __init__(self, rectification, level=1, num_disparities=128, block_size=5, workers=None, overlap=32):
+        """
+        Parameters:
+            rectification (dict): Stereo rectification (see rectification.get_rectification).
+            level (int): Pyramid level of the disparity (0 full resolution, 1 half, 2 quarter...).
+            num_disparities (int): Disparity search range at full resolution, in pixels.
+            block_size (int): Odd matching block size.
+            workers (int): Number of bands matched in parallel (None or 0 uses all CPU cores).
+            overlap (int): Rows shared by neighbouring bands.
+        """
+        self.rectification = rectification
+        self.level = level
+        self.scale = 2 ** level
+        self.workers = workers or os.cpu_count()
+        self.overlap = overlap
+
+        # The search range shrinks with the image, SGBM needs a multiple of 16
+        self.num_disparities = max(16, int(np.ceil(num_disparities / self.scale / 16)) * 16)
+        self.matchers = [cv.StereoSGBM_create(
+            minDisparity=0, numDisparities=self.num_disparities, blockSize=block_size,
+            P1=8 * block_size ** 2, P2=32 * block_size ** 2, disp12MaxDiff=1, uniquenessRatio=10,
+            speckleWindowSize=100, speckleRange=2, mode=cv.STEREO_SGBM_MODE_SGBM_3WAY
+        ) for _ in range(self.workers)]
+        self.pool = ThreadPoolExecutor(self.workers)
+
+        # Q reprojects (x, y, d) of the full resolution image, the level coordinates are scaled back first
+        self.Q = rectification['Q'] @ np.diag([self.scale, self.scale, 1., 1.])
+
+    def prepare(self, frame0, frame1):
+        """
+        Rectifies a pair and reduces it to the pyramid level.
+
+        Returns:
+            gray0, gray1 (numpy.ndarray): Grayscale images matched by disparity().
+            color0 (numpy.ndarray): First image at the same level, used to color the points.
+        """
+        with instrumentation.timer('dense.rectify'):
+            rectified0, rectified1 = rectify_pair(frame0, frame1, self.rectification)
+            for _ in range(self.level):
+                rectified0 = cv.pyrDown(rectified0)
+                rectified1 = cv.pyrDown(rectified1)
+
+        gray0 = cv.cvtColor(rectified0, cv.COLOR_BGR2GRAY) if rectified0.ndim == 3 else rectified0
+        gray1 = cv.cvtColor(rectified1, cv.COLOR_BGR2GRAY) if rectified1.ndim == 3 else rectified1
+        return gray0, gray1, rectified0
+
+    def _match_band(self, matcher, gray0, gray1, top, bottom):
+        start = max(top - self.overlap, 0)
+        stop = min(bottom + self.overlap, gray0.shape[0])
+        disparity = matcher.compute(gray0[start:stop], gray1[start:stop])
+        return disparity[top - start:bottom - start]
+
+    def disparity(self, gray0, gray1):
+        """
+        Returns the disparity of a prepared pair in pixels of the pyramid level (negative where invalid).
+        """
+        height = gray0.shape[0]
+        edges = np.linspace(0, height, len(self.matchers) + 1).astype(int)
+        with instrumentation.timer('dense.sgbm'):
+            bands = self.pool.map(self._match_band, self.matchers, [gray0] * len(self.matchers),
+                                  [gray1] * len(self.matchers), edges[:-1], edges[1:])
+            disparity = np.concatenate(list(bands))
+
+        # SGBM returns fixed-point disparities with 4 fractional bits
+        return disparity.astype(np.float32) / 16
+
+    def points(self, disparity, color0=None):
+        """
+        Reprojects a disparity map to 3D.
+
+        Returns:
+            cloud (numpy.ndarray): Structured array of point_dtype with the valid points.
+        """
+        with instrumentation.timer('dense.reproject'):
+            valid = disparity > 0
+            xyz = cv.reprojectImageTo3D(disparity * self.scale, self.Q)[valid]
+
+            cloud = np.empty(len(xyz), point_dtype)
+            cloud['x'], cloud['y'], cloud['z'] = xyz.T
+            if color0 is None:
+                cloud['red'] = cloud['green'] = cloud['blue'] = 255
+            elif color0.ndim == 2:
+                cloud['red'] = cloud['green'] = cloud['blue'] = color0[valid]
+            else:
+                cloud['blue'], cloud['green'], cloud['red'] = color0[valid].T
+        return cloud
+
+    def process(self, frame0, frame1):
+        """
+        Rectifies a pair, matches it and reprojects it.
+
+        Returns:
+            cloud (numpy.ndarray): Point cloud (see points()).
+            disparity (numpy.ndarray): Disparity at the pyramid level.
+        """
+        gray0, gray1, color0 = self.prepare(frame0, frame1)
+        disparity = self.disparity(gray0, gray1)
+        return self.points(disparity, color0), disparity
+
+    def close(self):
+        self.pool.shutdown()
+
+def save_point_cloud(filename, cloud):
+    """
+    Saves a point cloud as binary little-endian PLY (.ply) or as a NumPy structured array (.npy).
+    """
+    if os.path.splitext(filename)[1].lower() == '.npy':
+        np.save(filename, cloud)
+        return
+
+    header = ('ply\nformat binary_little_endian 1.0\n'
+              f'element vertex {len(cloud)}\n'
+              'property float x\nproperty float y\nproperty float z\n'
+              'property uchar red\nproperty uchar green\nproperty uchar blue\n'
+              'end_header\n')
+    with open(filename, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(np.ascontiguousarray(cloud, point_dtype).tobytes())
+
+def measure_fps(rectification, frame0, frame1, levels=(0, 1, 2), repeats=5, **options):
+    """
+    Measures the dense depth frame rate of a pair at several pyramid levels.
+
+    Parameters:
+        rectification (dict): Stereo rectification.
+        frame0, frame1 (numpy.ndarray): Raw frames of both cameras.
+        levels (tuple): Pyramid levels to measure.
+        repeats (int): Number of timed runs per level (after one warm-up run).
+        options: Other DenseStereo parameters.
+
+    Returns:
+        results (list): (level, (width, height), fps, number of points) for each level.
+    """
+    results = []
+    for level in levels:
+        dense = DenseStereo(rectification, level, **options)
+        cloud, disparity = dense.process(frame0, frame1)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            cloud, disparity = dense.process(frame0, frame1)
+        elapsed = time.perf_counter() - start
+        dense.close()
+
+        results.append((level, (disparity.shape[1], disparity.shape[0]), repeats / elapsed, len(cloud)))
+    return results
+
+def stream_dense(capture, dense, callback=None, max_frames=None):
+    """
+    Computes a point cloud for every synchronized pair of a camera stream.
+
+    Parameters:
+        capture: Pair source with a read() -> (ret, frame0, frame1, skew) method, e.g. both_webcams.StereoCapture.
+        dense (DenseStereo): Configured dense matcher.
+        callback (callable): Called with (cloud, disparity, stats) for every pair, if given.
+        max_frames (int): Stops after this number of pairs (None runs until the stream ends).
+
+    Yields:
+        cloud (numpy.ndarray): Point cloud of the pair.
+        disparity (numpy.ndarray): Disparity at the pyramid level.
+        stats (triangulation.LatencyStats): Per-frame latency and frame rate.
+    """
+    stats = LatencyStats()
+    frame_count = 0
+
+    while max_frames is None or frame_count < max_frames:
+        ret, frame0, frame1, skew = capture.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+
+        cloud, disparity = dense.process(frame0, frame1)
+
+        stats.add(time.perf_counter() - start)
+        instrumentation.count('dense.frames')
+        frame_count += 1
+        if callback is not None:
+            callback(cloud, disparity, stats)
+        yield cloud, disparity, stats
@@ -0,0 +1,186 @@
+import cv2 as cv
+import numpy as np
+from rectification import undistort_points
+import instrumentation
+
+# Feature detectors for automatic matching (both produce binary descriptors compared with the Hamming distance)
+feature_detectors = ('orb', 'akaze')
+
+def detect_features(gray, detector='orb', max_features=2000):
+    """
+    Detects keypoints and computes their binary descriptors.
+
+    Parameters:
+        gray (numpy.ndarray): Grayscale image.
+        detector (str): One of feature_detectors.
+        max_features (int): Maximum number of ORB keypoints (AKAZE keeps all of its keypoints).
+
+    Returns:
+        points (numpy.ndarray): (N,2) keypoint positions.
+        descriptors (numpy.ndarray): (N,B) uint8 descriptors.
+    """
+    if detector == 'orb':
+        extractor = cv.ORB_create(max_features)
+    elif detector == 'akaze' and hasattr(cv, 'AKAZE_create'):
+        extractor = cv.AKAZE_create()
+    else:
+        print('Unknown or unavailable feature detector:', detector)
+        quit()
+
+    with instrumentation.timer('matching.detect'):
+        keypoints, descriptors = extractor.detectAndCompute(gray, None)
+    if descriptors is None:
+        return np.empty((0, 2), np.float32), np.empty((0, 32), np.uint8)
+    return np.array([keypoint.pt for keypoint in keypoints], np.float32), descriptors
+
+# Number of set bits of every byte value, for Hamming distances of binary descriptors
+popcount = np.array([bin(value).count('1') for value in range(256)], np.uint8)
+
+def ragged_ranges(starts, counts):
+    """
+    Concatenation of arange(start, start + count) for every (start, count), without a Python loop.
+    """
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(offsets.size) - offsets
+
+class GridIndex:
+    """
+    Spatial index of 2D points bucketed in square cells, stored as one sorted array with per-cell offsets.
+
+    line_candidates() returns the points of the cells crossed by a band around each line, so a point is
+    only compared with the few points near its epipolar line instead of the whole image.
+    """
+
+    def __init__(self, points, image_size, cell_size=16):
+        self.cell_size = cell_size
+        self.columns = int(np.ceil(image_size[0] / cell_size)) + 1
+        self.rows = int(np.ceil(image_size[1] / cell_size)) + 1
+
+        cells = np.clip(np.floor(points / cell_size).astype(int), 0, [self.columns - 1, self.rows - 1])
+        cell_ids = cells[:, 1] * self.columns + cells[:, 0]
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.offsets = np.searchsorted(cell_ids[self.order], np.arange(self.rows * self.columns + 1))
+
+    def line_candidates(self, lines, band):
+        """
+        Finds the points in the cells within 'band' pixels of every line a*x + b*y + c = 0.
+
+        Parameters:
+            lines (numpy.ndarray): (N,3) line coefficients.
+            band (float): Distance to the lines, in pixels.
+
+        Returns:
+            line_ids, point_ids (numpy.ndarray): Candidate (line, point) pairs.
+        """
+        a, b, c = lines.T
+        horizontal = np.abs(b) >= np.abs(a)
+        line_ids = []
+        cell_ids = []
+
+        # Mostly horizontal lines are walked one cell column at a time, the others one cell row at a time
+        for walked, steps, other, step_stride, other_stride, p, q in (
+                (horizontal, self.columns, self.rows, 1, self.columns, a, b),
+                (~horizontal, self.rows, self.columns, self.columns, 1, b, a)):
+            selected = np.flatnonzero(walked)
+            p, q, r = p[selected, None], q[selected, None], c[selected, None]
+
+            # Crossing of each line with the borders of each step, widened by the band along the cross axis
+            starts = np.arange(steps) * self.cell_size
+            crossing0 = -(p * starts + r) / q
+            crossing1 = -(p * (starts + self.cell_size) + r) / q
+            cross_band = band * np.hypot(p, q) / np.abs(q)
+            low = np.floor((np.minimum(crossing0, crossing1) - cross_band) / self.cell_size).astype(int)
+            high = np.floor((np.maximum(crossing0, crossing1) + cross_band) / self.cell_size).astype(int)
+            inside = (high >= 0) & (low < other)
+            low = np.clip(low, 0, other - 1)
+            crossed = np.flatnonzero(inside)
+            low = low.ravel()[crossed]
+            counts = np.clip(high, 0, other - 1).ravel()[crossed] - low + 1
+
+            line_ids.append(np.repeat(selected[crossed // steps], counts))
+            cell_ids.append(np.repeat(crossed % steps * step_stride, counts) + ragged_ranges(low, counts) * other_stride)
+
+        line_ids = np.concatenate(line_ids)
+        cell_ids = np.concatenate(cell_ids)
+
+        # Expand every (line, cell) to the points of the cell
+        starts = self.offsets[cell_ids]
+        counts = self.offsets[cell_ids + 1] - starts
+        return np.repeat(line_ids, counts), self.order[ragged_ranges(starts, counts)]
+
+def epipolar_match(points0, descriptors0, points1, descriptors1, F, image_size, band=2.0, ratio=0.8):
+    """
+    Matches features of two views, only comparing each feature of the first view with the features of the
+    second view within 'band' pixels of its epipolar line.
+
+    Parameters:
+        points0, points1 (numpy.ndarray): (N,2) undistorted keypoint positions in each view.
+        descriptors0, descriptors1 (numpy.ndarray): Binary descriptors of the keypoints.
+        F (numpy.ndarray): Fundamental matrix from stereo calibration (x1^T F x0 = 0).
+        image_size (tuple): (width, height) of the second view.
+        band (float): Maximum distance to the epipolar line, in pixels.
+        ratio (float): Lowe's ratio test between the best and second best candidate.
+
+    Returns:
+        matches (numpy.ndarray): (M,2) indices (first view, second view) of the matched keypoints. Every
+            keypoint of the second view is used at most once.
+    """
+    if len(points0) == 0 or len(points1) == 0:
+        return np.empty((0, 2), int)
+
+    with instrumentation.timer('matching.epipolar'):
+        index = GridIndex(points1, image_size)
+        lines = np.column_stack([points0, np.ones(len(points0))]) @ F.T
+        line_ids, point_ids = index.line_candidates(lines, band)
+
+        # Exact distance to the epipolar line
+        line = lines[line_ids]
+        distance = np.abs(np.sum(points1[point_ids] * line[:, :2], axis=1) + line[:, 2]) / np.hypot(line[:, 0], line[:, 1])
+        line_ids, point_ids = line_ids[distance <= band], point_ids[distance <= band]
+
+        # Best and second best candidate of every feature of the first view
+        hamming = popcount[descriptors0[line_ids] ^ descriptors1[point_ids]].sum(axis=1, dtype=np.int32)
+        order = np.lexsort((hamming, line_ids))
+        line_ids, point_ids, hamming = line_ids[order], point_ids[order], hamming[order]
+        best = np.flatnonzero(np.r_[True, line_ids[1:] != line_ids[:-1]])
+        has_second = np.r_[best[1:], len(line_ids)] - best > 1
+        second = np.where(has_second, hamming[np.minimum(best + 1, len(hamming) - 1)], np.inf)
+        best = best[hamming[best] < ratio * second]
+
+        # Keep the closest match of every keypoint of the second view
+        matches = np.column_stack([line_ids[best], point_ids[best]])
+        order = np.lexsort((hamming[best], matches[:, 1]))
+        first = np.r_[True, matches[order[1:], 1] != matches[order[:-1], 1]]
+        return matches[np.sort(order[first])]
+
+def match_stereo(image0, image1, F, mtx1=None, dist1=None, mtx2=None, dist2=None, detector='orb', max_features=2000,
+                 band=2.0, ratio=0.8):
+    """
+    Finds corresponding points in a stereo pair automatically, replacing click_recognize.
+
+    Parameters:
+        image0, image1 (numpy.ndarray): Images of the first and second camera (BGR or grayscale).
+        F (numpy.ndarray): Fundamental matrix from stereo calibration.
+        mtx1, dist1, mtx2, dist2 (numpy.ndarray): Camera matrices and distortion coefficients. When given,
+            the keypoints are undistorted before the epipolar test.
+        detector (str): One of feature_detectors.
+        max_features (int): Maximum number of keypoints per image.
+        band (float): Maximum distance to the epipolar line, in pixels.
+        ratio (float): Lowe's ratio test threshold.
+
+    Returns:
+        points0, points1 (numpy.ndarray): (N,2) matched pixel coordinates in the raw images, in the same
+            order, ready for triangulation.
+    """
+    gray0 = cv.cvtColor(image0, cv.COLOR_BGR2GRAY) if image0.ndim == 3 else image0
+    gray1 = cv.cvtColor(image1, cv.COLOR_BGR2GRAY) if image1.ndim == 3 else image1
+    points0, descriptors0 = detect_features(gray0, detector, max_features)
+    points1, descriptors1 = detect_features(gray1, detector, max_features)
+
+    # F relates undistorted pixels
+    ideal0 = undistort_points(points0, mtx1, dist1) if dist1 is not None else points0
+    ideal1 = undistort_points(points1, mtx2, dist2) if dist2 is not None else points1
+
+    matches = epipolar_match(ideal0, descriptors0, ideal1, descriptors1, F, (gray1.shape[1], gray1.shape[0]), band, ratio)
+    instrumentation.count('matching.matches', len(matches))
+    return points0[matches[:, 0]].astype(np.float64), points1[matches[:, 1]].astype(np.float64)
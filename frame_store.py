@@ -0,0 +1,169 @@
+import hashlib
+import os
+from collections import namedtuple
+import cv2 as cv
+import numpy as np
+
+# Reference to one frame of a frame store (picklable, so it can be sent to detection workers)
+StoredFrame = namedtuple('StoredFrame', ['foldername', 'index'])
+
+# Open stores, so repeated reads of the same session share one memory map
+open_stores = {}
+
+class FrameStore:
+    """
+    Session frame store: every frame of a session is appended to one raw file ('frames.raw') that is read
+    back as a memory-mapped (N, height, width, channels) uint8 array. A small index ('frames_index.npz')
+    records the frame shape and, for each frame, the camera name, frame number, capture timestamp and the
+    SHA-1 digest of its pixels (the key of the detection cache, so it is computed once when the frame is written).
+
+    Reading a frame is a view into the memory map: there is no image decoding and, for grayscale stores,
+    no color conversion.
+    """
+
+    raw_name = 'frames.raw'
+    index_name = 'frames_index.npz'
+
+    def __init__(self, foldername):
+        """
+        Opens an existing frame store for reading.
+
+        Parameters:
+            foldername (str): Folder containing the store.
+        """
+        self.foldername = foldername
+        self.file = None
+
+        with np.load(os.path.join(foldername, self.index_name), allow_pickle=False) as index:
+            self.shape = tuple(int(v) for v in index['shape'])
+            self.camera = index['camera']
+            self.number = index['number']
+            self.timestamp = index['timestamp']
+            # Stores written before the digests were recorded have none
+            self.digest = index['digest'] if 'digest' in index else None
+
+        if len(self.camera):
+            self.data = np.memmap(os.path.join(foldername, self.raw_name), dtype=np.uint8, mode='r',
+                                  shape=(len(self.camera),) + self.shape)
+        else:
+            self.data = np.empty((0,) + self.shape, np.uint8)
+
+    @classmethod
+    def create(cls, foldername, shape):
+        """
+        Creates an empty frame store for writing, replacing any previous session in the folder.
+
+        Parameters:
+            foldername (str): Folder of the store (created if needed).
+            shape (tuple): (height, width, channels) of every frame.
+        """
+        if not os.path.exists(foldername):
+            os.mkdir(foldername)
+
+        # Drop the memory map of the previous session before truncating its file
+        open_stores.pop(os.path.abspath(foldername), None)
+
+        store = cls.__new__(cls)
+        store.foldername = foldername
+        store.shape = tuple(int(v) for v in shape)
+        store.camera = []
+        store.number = []
+        store.timestamp = []
+        store.digest = []
+        store.file = open(os.path.join(foldername, cls.raw_name), 'wb')
+        store.write_index()
+        return store
+
+    @classmethod
+    def exists(cls, foldername):
+        return os.path.exists(os.path.join(foldername, cls.index_name))
+
+    @classmethod
+    def remove(cls, foldername):
+        """
+        Deletes the frame store of a folder (raw frames and index).
+        """
+        open_stores.pop(os.path.abspath(foldername), None)
+        for name in (cls.raw_name, cls.index_name):
+            path = os.path.join(foldername, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def write_index(self):
+        # Written next to the final file first so a reader never sees a partial index
+        path = os.path.join(self.foldername, self.index_name)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 shape=np.array(self.shape, dtype=np.int64),
+                 camera=np.array(self.camera, dtype=str),
+                 number=np.array(self.number, dtype=np.int32),
+                 timestamp=np.array(self.timestamp, dtype=np.float64),
+                 digest=np.array(self.digest, dtype=str))
+        os.replace(tmp_path, path)
+
+    def append(self, camera, number, timestamp, frame):
+        """
+        Appends one frame. Color frames are converted to grayscale if the store has one channel.
+
+        Parameters:
+            camera (str): Camera name (key of the camera in the calibration settings).
+            number (int): Frame number in the session.
+            timestamp (float): Capture time (seconds since the epoch).
+            frame (numpy.ndarray): Frame to store.
+        """
+        if self.shape[2] == 1 and frame.ndim == 3:
+            frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.size != np.prod(self.shape):
+            raise ValueError(f'Frame of shape {frame.shape} does not fit a store of shape {self.shape}')
+
+        self.file.write(memoryview(frame).cast('B'))
+        self.file.flush()
+        self.camera.append(camera)
+        self.number.append(number)
+        self.timestamp.append(timestamp)
+        self.digest.append(hashlib.sha1(frame).hexdigest())
+        self.write_index()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def frames(self, camera):
+        """
+        Returns the frames of one camera, sorted by frame number.
+
+        Parameters:
+            camera (str): Camera name.
+
+        Returns:
+            frames (list): StoredFrame references.
+        """
+        indices = np.flatnonzero(np.asarray(self.camera, dtype=str) == camera)
+        indices = indices[np.argsort(np.asarray(self.number)[indices], kind='stable')]
+        return [StoredFrame(self.foldername, int(i)) for i in indices]
+
+    def image(self, index):
+        """
+        Returns a frame as a (height, width) or (height, width, 3) view of the memory map (no copy).
+        """
+        frame = self.data[index]
+        return frame[:, :, 0] if self.shape[2] == 1 else frame
+
+    def gray(self, index):
+        """
+        Returns a frame in grayscale. For grayscale stores this is a view of the memory map (no copy).
+        """
+        frame = self.image(index)
+        return frame if frame.ndim == 2 else cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+def open_frame_store(foldername):
+    """
+    Returns the frame store of a folder opened for reading, reusing the memory map while the index is unchanged.
+    """
+    mtime = os.stat(os.path.join(foldername, FrameStore.index_name)).st_mtime_ns
+    key = os.path.abspath(foldername)
+    if key not in open_stores or open_stores[key][0] != mtime:
+        open_stores[key] = (mtime, FrameStore(foldername))
+    return open_stores[key][1]
@@ -0,0 +1,125 @@
+import csv
+import functools
+import json
+import threading
+import time
+from contextlib import nullcontext
+import numpy as np
+
+# Instrumentation is off by default: timer() then returns a shared no-op context and count() returns at once
+enabled = False
+
+durations = {}  # Timer name -> list of durations in seconds
+counters = {}  # Counter name -> value
+lock = threading.Lock()
+null_timer = nullcontext()
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def reset():
+    with lock:
+        durations.clear()
+        counters.clear()
+
+class Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with lock:
+            durations.setdefault(self.name, []).append(elapsed)
+
+def timer(name):
+    """
+    Context manager timing a block under 'name' (a no-op while instrumentation is disabled).
+    """
+    return Timer(name) if enabled else null_timer
+
+def timed(name=None):
+    """
+    Decorator timing every call of a function under 'name' (the function name by default).
+    """
+    def decorator(function):
+        label = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Timer(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    """
+    Adds n to a counter (frames, dropped frames, detection failures...).
+    """
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+def summary():
+    """
+    Returns the timers (count, total, mean and percentile latencies in milliseconds) and the counters.
+    """
+    with lock:
+        timers = {name: np.array(values) * 1000 for name, values in durations.items()}
+        counts = dict(counters)
+
+    stats = {}
+    for name, values in timers.items():
+        stats[name] = {
+            'count': int(len(values)),
+            'total_ms': float(values.sum()),
+            'mean_ms': float(values.mean()),
+            'p50_ms': float(np.percentile(values, 50)),
+            'p95_ms': float(np.percentile(values, 95)),
+            'p99_ms': float(np.percentile(values, 99)),
+            'max_ms': float(values.max()),
+        }
+    return {'timers': stats, 'counters': counts}
+
+def print_summary():
+    result = summary()
+    if not result['timers'] and not result['counters']:
+        return
+
+    print(f"{'timer':<32}{'count':>8}{'total ms':>12}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, s in sorted(result['timers'].items()):
+        print(f"{name:<32}{s['count']:>8}{s['total_ms']:>12.1f}{s['mean_ms']:>10.2f}{s['p50_ms']:>10.2f}"
+              f"{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}{s['max_ms']:>10.2f}")
+    for name, value in sorted(result['counters'].items()):
+        print(f'{name:<32}{value:>8}')
+
+def export_json(filename):
+    with open(filename, 'w') as f:
+        json.dump(summary(), f, indent=2)
+
+def export_csv(filename):
+    result = summary()
+    fields = ['count', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'kind'] + fields)
+        for name, s in sorted(result['timers'].items()):
+            writer.writerow([name, 'timer'] + [s[field] for field in fields])
+        for name, value in sorted(result['counters'].items()):
+            writer.writerow([name, 'counter', value] + [''] * (len(fields) - 1))
+
+def export(filename):
+    """
+    Writes the summary as CSV if the file name ends with .csv, as JSON otherwise.
+    """
+    if filename.lower().endswith('.csv'):
+        export_csv(filename)
+    else:
+        export_json(filename)
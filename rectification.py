@@ -0,0 +1,101 @@
+import hashlib
+import os
+import cv2 as cv
+import numpy as np
+
+def calibration_hash(mtx1, dist1, mtx2, dist2, R, T, image_size):
+    """
+    Returns a hash of the stereo calibration, used to know when the rectification maps are out of date.
+    """
+    h = hashlib.sha1()
+    for array in (mtx1, dist1, mtx2, dist2, R, T, image_size):
+        h.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def compute_rectification(mtx1, dist1, mtx2, dist2, R, T, image_size, alpha=0):
+    """
+    Computes the stereo rectification and the undistortion/rectification remap tables of both cameras.
+
+    The maps are stored in OpenCV's fixed-point form (CV_16SC2 integer coordinates plus a CV_16UC1
+    interpolation table), which is half the size of float maps and the fastest input for cv.remap.
+
+    Parameters:
+        mtx1, dist1, mtx2, dist2, R, T (numpy.ndarray): Stereo calibration.
+        image_size (tuple): (width, height) of the frames.
+        alpha (float): Free scaling of stereoRectify (0 keeps only valid pixels, 1 keeps all source pixels).
+
+    Returns:
+        rectification (dict): R1, R2, P1, P2, Q, image_size, map1_0, map2_0 (first camera),
+            map1_1, map2_1 (second camera) and calibration_hash.
+    """
+    image_size = tuple(int(v) for v in image_size)
+    R1, R2, P1, P2, Q, _, _ = cv.stereoRectify(mtx1, dist1, mtx2, dist2, image_size, R, T, alpha=alpha)
+    map1_0, map2_0 = cv.initUndistortRectifyMap(mtx1, dist1, R1, P1, image_size, cv.CV_16SC2)
+    map1_1, map2_1 = cv.initUndistortRectifyMap(mtx2, dist2, R2, P2, image_size, cv.CV_16SC2)
+
+    return {
+        'R1': R1, 'R2': R2, 'P1': P1, 'P2': P2, 'Q': Q,
+        'image_size': image_size,
+        'map1_0': map1_0, 'map2_0': map2_0, 'map1_1': map1_1, 'map2_1': map2_1,
+        'calibration_hash': calibration_hash(mtx1, dist1, mtx2, dist2, R, T, image_size),
+    }
+
+def save_rectification(filename, rectification):
+    np.savez(filename, **{key: np.asarray(value) for key, value in rectification.items()})
+
+def load_rectification(filename, expected_calibration_hash=None):
+    """
+    Loads rectification maps saved by save_rectification.
+
+    Returns:
+        rectification (dict): See compute_rectification, or None if the file is missing or was made
+            from another calibration.
+    """
+    if not os.path.exists(filename):
+        return None
+
+    with np.load(filename, allow_pickle=False) as data:
+        rectification = {key: data[key] for key in data.files}
+    rectification['calibration_hash'] = str(rectification['calibration_hash'])
+    rectification['image_size'] = tuple(int(v) for v in rectification['image_size'])
+
+    if expected_calibration_hash is not None and rectification['calibration_hash'] != expected_calibration_hash:
+        return None
+    return rectification
+
+def get_rectification(filename, mtx1, dist1, mtx2, dist2, R, T, image_size):
+    """
+    Returns the rectification of a calibration, loaded from 'filename' if it is up to date, otherwise
+    computed and saved there (once per calibration).
+    """
+    rectification = load_rectification(filename, calibration_hash(mtx1, dist1, mtx2, dist2, R, T, image_size))
+    if rectification is None:
+        rectification = compute_rectification(mtx1, dist1, mtx2, dist2, R, T, image_size)
+        save_rectification(filename, rectification)
+    return rectification
+
+def rectify_pair(frame0, frame1, rectification, interpolation=cv.INTER_LINEAR):
+    """
+    Undistorts and rectifies a pair of frames with the precomputed remap tables.
+    """
+    rectified0 = cv.remap(frame0, rectification['map1_0'], rectification['map2_0'], interpolation)
+    rectified1 = cv.remap(frame1, rectification['map1_1'], rectification['map2_1'], interpolation)
+    return rectified0, rectified1
+
+def undistort_points(points, mtx, dist, R=None, P=None):
+    """
+    Removes the lens distortion of N pixel coordinates in one call.
+
+    Parameters:
+        points (array-like): (N,2) pixel coordinates in the raw image.
+        mtx, dist (numpy.ndarray): Camera matrix and distortion coefficients.
+        R, P (numpy.ndarray): Rectification rotation and new projection matrix. Without them the points
+            are returned as ideal (distortion-free) pixel coordinates of the same camera matrix.
+
+    Returns:
+        points (numpy.ndarray): (N,2) corrected pixel coordinates.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+    if len(points) == 0:
+        return points.reshape(0, 2)
+    return cv.undistortPoints(points, mtx, dist, R=R, P=mtx if P is None else P).reshape(-1, 2)
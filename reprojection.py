@@ -0,0 +1,257 @@
+import cv2 as cv
+import numpy as np
+import instrumentation
+
+# Distortion coefficients handled by the vectorized model: k1, k2, p1, p2, k3 and the rational k4, k5, k6
+# (the thin prism and tilt terms of longer vectors fall back to cv.projectPoints)
+vectorized_distortion_terms = 8
+
+def rotation_matrices(rvecs):
+    """
+    Rodrigues formula for F rotation vectors at once.
+
+    Parameters:
+        rvecs (array-like): (F,3) rotation vectors.
+
+    Returns:
+        Rs (numpy.ndarray): (F,3,3) rotation matrices.
+    """
+    rvecs = np.asarray(rvecs, dtype=np.float64).reshape(-1, 3)
+    theta = np.linalg.norm(rvecs, axis=1)[:, None, None]
+    axis = rvecs / np.where(theta[:, :, 0] > 1e-12, theta[:, :, 0], 1)
+
+    K = np.zeros((len(rvecs), 3, 3))
+    K[:, 0, 1], K[:, 0, 2] = -axis[:, 2], axis[:, 1]
+    K[:, 1, 0], K[:, 1, 2] = axis[:, 2], -axis[:, 0]
+    K[:, 2, 0], K[:, 2, 1] = -axis[:, 1], axis[:, 0]
+    return np.eye(3) + np.sin(theta) * K + (1 - np.cos(theta)) * (K @ K)
+
+def project_points(points, R, t, mtx, dist=None):
+    """
+    Projects M points with the OpenCV camera model in one pass (the batched equivalent of cv.projectPoints).
+
+    Parameters:
+        points (array-like): (M,3) points.
+        R (array-like): (3,3) rotation, or (M,3,3) with one rotation per point.
+        t (array-like): (3,) translation, or (M,3) with one translation per point.
+        mtx (numpy.ndarray): Camera matrix.
+        dist (numpy.ndarray): Distortion coefficients (None for an ideal camera).
+
+    Returns:
+        uvs (numpy.ndarray): (M,2) pixel coordinates.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    R = np.asarray(R, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64).reshape(-1, 3)
+    dist = np.zeros(0) if dist is None else np.ravel(dist).astype(np.float64)
+
+    if dist.size > vectorized_distortion_terms and np.any(dist[vectorized_distortion_terms:]):
+        # Thin prism / tilted sensor models: cv.projectPoints for the pose, or for each point with its own pose
+        if R.ndim == 2:
+            return cv.projectPoints(points, cv.Rodrigues(R)[0], t[0], mtx, dist)[0].reshape(-1, 2)
+        return np.array([cv.projectPoints(point[None], cv.Rodrigues(rotation)[0], translation, mtx, dist)[0].ravel()
+                         for point, rotation, translation in zip(points, R, np.broadcast_to(t, points.shape))])
+
+    camera = np.einsum('...ij,...j->...i', R, points) + t
+    x = camera[:, 0] / camera[:, 2]
+    y = camera[:, 1] / camera[:, 2]
+
+    coefficients = np.zeros(vectorized_distortion_terms)
+    coefficients[:min(dist.size, vectorized_distortion_terms)] = dist[:vectorized_distortion_terms]
+    k1, k2, p1, p2, k3, k4, k5, k6 = coefficients
+    r2 = x * x + y * y
+    radial = (1 + r2 * (k1 + r2 * (k2 + r2 * k3))) / (1 + r2 * (k4 + r2 * (k5 + r2 * k6)))
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+
+    # As in cv.projectPoints, the skew of the camera matrix is ignored
+    return np.column_stack([mtx[0, 0] * xd + mtx[0, 2], mtx[1, 1] * yd + mtx[1, 2]])
+
+@instrumentation.timed('reprojection.views')
+def view_residuals(objpoints, imgpoints, rvecs, tvecs, mtx, dist):
+    """
+    Reprojection residuals of every corner of every calibration view, projected in a single batch.
+
+    Parameters:
+        objpoints (list): Board points of each view ((N_i,3), views may have different numbers of points).
+        imgpoints (list): Detected corners of each view ((N_i,1,2) or (N_i,2)).
+        rvecs, tvecs (list): Board pose of each view, as returned by cv.calibrateCamera (the rotations may
+            also be given as (F,3,3) matrices).
+        mtx, dist (numpy.ndarray): Camera matrix and distortion coefficients.
+
+    Returns:
+        residuals (numpy.ndarray): (M,2) projected minus detected pixel coordinates of all corners.
+        view_ids (numpy.ndarray): (M,) index of the view of each corner.
+    """
+    counts = [len(np.reshape(objp, (-1, 3))) for objp in objpoints]
+    view_ids = np.repeat(np.arange(len(counts)), counts)
+    points = np.concatenate([np.reshape(objp, (-1, 3)) for objp in objpoints])
+    corners = np.concatenate([np.reshape(corners, (-1, 2)) for corners in imgpoints])
+
+    Rs = np.asarray(rvecs, dtype=np.float64) if np.shape(rvecs)[-2:] == (3, 3) else rotation_matrices(rvecs)
+    ts = np.reshape(tvecs, (-1, 3))
+    projected = project_points(points, Rs[view_ids], ts[view_ids], mtx, dist)
+    return projected - corners, view_ids
+
+def view_errors(residuals, view_ids, view_count=None):
+    """
+    Returns the RMS reprojection error of every view from the residuals of view_residuals().
+    """
+    squared = np.bincount(view_ids, np.sum(residuals ** 2, axis=1), view_count)
+    return np.sqrt(squared / np.maximum(np.bincount(view_ids, minlength=len(squared)), 1))
+
+def outliers(errors, factor=2.0):
+    """
+    Flags the errors above factor times the median error (NaN errors are not flagged).
+    """
+    errors = np.asarray(errors, dtype=np.float64)
+    valid = ~np.isnan(errors)
+    flags = np.zeros(errors.shape, bool)
+    if valid.any():
+        flags[valid] = errors[valid] > factor * np.median(errors[valid])
+    return flags
+
+def residual_report(objpoints, imgpoints, rvecs, tvecs, mtx, dist, factor=2.0):
+    """
+    Per-view and per-corner reprojection analytics of a calibration.
+
+    Returns:
+        report (dict):
+            view_errors: (F,) RMS error of every view, in pixels.
+            corner_errors: (F,N) error of every corner (NaN padded when views have fewer corners).
+            outlier_views: (F,) views whose error is above factor times the median view error.
+            outlier_corners: (F,N) corners whose error is above factor times the median corner error.
+    """
+    residuals, view_ids = view_residuals(objpoints, imgpoints, rvecs, tvecs, mtx, dist)
+    errors = np.linalg.norm(residuals, axis=1)
+
+    # Ragged views are laid out in a NaN padded (views, corners) table
+    counts = np.bincount(view_ids, minlength=len(objpoints))
+    corner_errors = np.full((len(counts), counts.max(initial=0)), np.nan)
+    corner_errors[view_ids, np.arange(len(view_ids)) - np.repeat(np.cumsum(counts) - counts, counts)] = errors
+
+    per_view = view_errors(residuals, view_ids, len(counts))
+    return {'view_errors': per_view, 'corner_errors': corner_errors,
+            'outlier_views': outliers(per_view, factor), 'outlier_corners': outliers(corner_errors, factor)}
+
+def point_residuals(Ps, uvs, p3ds):
+    """
+    Reprojection residuals of N 3D points in C views.
+
+    Parameters:
+        Ps (numpy.ndarray): (C,3,4) projection matrices.
+        uvs (array-like): (C,N,2) observed (undistorted) pixel coordinates, NaN where a point is not visible.
+        p3ds (numpy.ndarray): (N,3) points.
+
+    Returns:
+        residuals (numpy.ndarray): (C,N,2) projected minus observed pixel coordinates (NaN where not visible).
+        homogeneous (numpy.ndarray): (C,N,3) projections P @ [X, 1].
+    """
+    homogeneous = p3ds @ np.transpose(Ps[:, :, :3], (0, 2, 1)) + Ps[:, None, :, 3]
+    return homogeneous[:, :, :2] / homogeneous[:, :, 2:] - uvs, homogeneous
+
+def point_errors(residuals):
+    """
+    Returns the RMS reprojection error of every point over the views it was seen in, in pixels.
+    """
+    squared = np.sum(residuals ** 2, axis=2)
+    visible = ~np.isnan(squared)
+    with np.errstate(invalid='ignore'):
+        return np.sqrt(np.where(visible, squared, 0).sum(axis=0) / visible.sum(axis=0))
+
+def solve_3x3(A, b):
+    """
+    Solves N 3x3 systems A x = b with the adjugate (much faster than numpy.linalg.solve for tiny systems).
+
+    Parameters:
+        A (numpy.ndarray): (3,3,N) matrices, the systems along the last axis.
+        b (numpy.ndarray): (3,N) right-hand sides.
+
+    Returns:
+        x (numpy.ndarray): (3,N) solutions (zero for singular systems).
+    """
+    c0, c1, c2 = np.cross(A[1], A[2], axis=0), np.cross(A[2], A[0], axis=0), np.cross(A[0], A[1], axis=0)
+    determinant = np.sum(A[0] * c0, axis=0)
+    singular = np.abs(determinant) < 1e-300
+    x = (c0 * b[0] + c1 * b[1] + c2 * b[2]) / np.where(singular, 1, determinant)
+    x[:, singular] = 0
+    return x
+
+@instrumentation.timed('reprojection.refine_points')
+def refine_points(Ps, uvs, p3ds, max_iterations=10, tolerance=1e-8):
+    """
+    Levenberg-Marquardt refinement of N triangulated points minimizing their reprojection error in every view.
+
+    Each point is an independent 3-parameter problem: the 3x3 normal equations of all the points are built
+    and solved at once, with a damping factor per point (Gauss-Newton steps while the error decreases,
+    towards gradient descent when a step fails).
+
+    Parameters:
+        Ps (numpy.ndarray): (C,3,4) projection matrices.
+        uvs (array-like): (C,N,2) undistorted pixel coordinates, NaN where a point is not visible.
+        p3ds (numpy.ndarray): (N,3) initial points, e.g. from DLT_batch or DLT_multiview.
+        max_iterations (int): Maximum number of iterations.
+        tolerance (float): A point stops when its step is below this fraction of its distance.
+
+    Returns:
+        p3ds (numpy.ndarray): (N,3) refined points (NaN where the initial point was NaN).
+        errors (numpy.ndarray): (N,) RMS reprojection error of the refined points, in pixels.
+    """
+    Ps = np.asarray(Ps, dtype=np.float64)
+    uvs = np.asarray(uvs, dtype=np.float64).reshape(len(Ps), -1, 2)
+    initial = np.asarray(p3ds, dtype=np.float64).reshape(-1, 3)
+    visible = ~np.isnan(uvs).any(axis=2) & ~np.isnan(initial).any(axis=1)
+    active = visible.sum(axis=0) >= 2
+    instrumentation.count('reprojection.refined_points', int(active.sum()))
+
+    # The points are along the last axis of every array, hidden observations are zeroed out of the sums
+    X = np.where(active, initial.T, 0)
+    observed = np.where(visible[:, None], uvs.transpose(0, 2, 1), 0)
+    weights = visible[:, None].astype(np.float64)
+
+    def project(X):
+        h = Ps[:, :, :3] @ X + Ps[:, :, 3, None]
+        h[:, 2][~visible] = 1
+        return h, (h[:, :2] / h[:, 2:] - observed) * weights
+
+    h, r = project(X)
+    cost = np.sum(r ** 2, axis=(0, 1))
+    damping = np.full(len(initial), 1e-3)
+
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        instrumentation.count('reprojection.refine_iterations')
+
+        # Jacobian of (u, v) = (h0 / h2, h1 / h2) with respect to X: (P_row - u * P_2) / h2, (C,2,3,N)
+        projected = h[:, :2] / h[:, 2:]
+        J = (Ps[:, :2, :3, None] - projected[:, :, None] * Ps[:, None, 2, :3, None]) / h[:, None, 2:]
+        J *= weights[:, :, None]
+
+        # Damped normal equations (JtJ + damping * diag(JtJ)) step = -Jt r
+        JtJ = np.einsum('ckin,ckjn->ijn', J, J)
+        Jtr = np.einsum('ckin,ckn->in', J, r)
+        JtJ[[0, 1, 2], [0, 1, 2]] *= 1 + damping
+        step = -solve_3x3(JtJ, Jtr) * active
+
+        candidate_h, candidate_r = project(X + step)
+        candidate_cost = np.sum(candidate_r ** 2, axis=(0, 1))
+
+        # Steps that lower the error are kept (less damping), the others are retried with more damping
+        improved = active & (candidate_cost < cost)
+        X = np.where(improved, X + step, X)
+        h = np.where(improved, candidate_h, h)
+        r = np.where(improved, candidate_r, r)
+        cost = np.where(improved, candidate_cost, cost)
+        damping = np.where(improved, damping / 10, damping * 10)
+
+        # A point stops when its step becomes negligible or the damping no longer finds a better point
+        small = np.linalg.norm(step, axis=0) <= tolerance * np.maximum(np.linalg.norm(X, axis=0), 1)
+        active &= ~small & (damping < 1e8)
+
+    refined = visible.sum(axis=0) >= 2
+    p3ds = np.where(refined[:, None], X.T, initial)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        errors = np.sqrt(cost / visible.sum(axis=0))
+    errors[~refined] = np.nan
+    return p3ds, errors
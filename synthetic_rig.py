@@ -0,0 +1,197 @@
+import cv2 as cv
+import numpy as np
+
+# Squares of white margin around the rendered checkerboard
+board_margin = 1
+
+def board_object_points(rows, columns):
+    """
+    Returns the checkerboard inner corners in board coordinates (one unit per square), in the order used by calibration.
+    """
+    objp = np.zeros((rows * columns, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:rows, 0:columns].T.reshape(-1, 2)
+    return objp
+
+def board_texture(rows, columns, square_px=64):
+    """
+    Draws a checkerboard with rows x columns inner corners and a white margin.
+
+    Returns:
+        texture (numpy.ndarray): Grayscale image of the board.
+    """
+    squares_x = rows + 1
+    squares_y = columns + 1
+    i, j = np.mgrid[0:squares_y, 0:squares_x]
+    squares = np.where((i + j) % 2 == 0, 0, 255).astype(np.uint8)
+    texture = np.kron(squares, np.ones((square_px, square_px), np.uint8))
+    border = board_margin * square_px
+    return cv.copyMakeBorder(texture, border, border, border, border, cv.BORDER_CONSTANT, value=255)
+
+def normalized_grid(K, dist, size):
+    """
+    Returns the undistorted normalized camera coordinates of every pixel of an image, as two (height, width) maps.
+    """
+    width, height = size
+    u, v = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    pixels = np.stack([u.ravel(), v.ravel()], axis=-1).reshape(-1, 1, 2)
+    normalized = cv.undistortPoints(pixels, K, dist).reshape(height, width, 2)
+    return normalized[:, :, 0], normalized[:, :, 1]
+
+def render_board(K, dist, rvec, tvec, size, rows, columns, noise=0.0, grid=None, texture=None, square_px=64, background=128):
+    """
+    Renders a checkerboard seen by a camera with known intrinsics, distortion and board pose.
+
+    Parameters:
+        K, dist (numpy.ndarray): Camera matrix and distortion coefficients.
+        rvec, tvec (numpy.ndarray): Board pose in the camera frame (board units are squares).
+        size (tuple): (width, height) of the image.
+        rows, columns (int): Checkerboard dimensions (inner corners).
+        noise (float): Standard deviation of the gaussian pixel noise.
+        grid (tuple): Precomputed normalized_grid(K, dist, size), to render many frames of the same camera faster.
+        texture (numpy.ndarray): Precomputed board_texture(rows, columns, square_px).
+
+    Returns:
+        image (numpy.ndarray): Grayscale rendered image.
+        corners (numpy.ndarray): (rows*columns, 2) ground truth pixel positions of the inner corners.
+    """
+    if grid is None:
+        grid = normalized_grid(K, dist, size)
+    if texture is None:
+        texture = board_texture(rows, columns, square_px)
+
+    # Homography from board coordinates to normalized camera coordinates
+    R, _ = cv.Rodrigues(np.asarray(rvec, np.float64))
+    H = np.column_stack([R[:, 0], R[:, 1], np.ravel(tvec)])
+    Hinv = np.linalg.inv(H)
+
+    x, y = grid
+    bx = Hinv[0, 0] * x + Hinv[0, 1] * y + Hinv[0, 2]
+    by = Hinv[1, 0] * x + Hinv[1, 1] * y + Hinv[1, 2]
+    bw = Hinv[2, 0] * x + Hinv[2, 1] * y + Hinv[2, 2]
+    bx /= bw
+    by /= bw
+
+    # Board coordinates to texture pixel centers (the first inner corner is one square inside the margin)
+    offset = board_margin + 1
+    map_x = ((bx + offset) * square_px - 0.5).astype(np.float32)
+    map_y = ((by + offset) * square_px - 0.5).astype(np.float32)
+    map_x[bw <= 0] = -1
+    image = cv.remap(texture, map_x, map_y, cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT, borderValue=background)
+
+    if noise > 0:
+        image = np.clip(image + np.random.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+
+    corners, _ = cv.projectPoints(board_object_points(rows, columns), np.asarray(rvec, np.float64),
+                                  np.asarray(tvec, np.float64), K, dist)
+    return image, corners.reshape(-1, 2)
+
+def random_board_pose(K, size, rows, columns, distance_range=(12, 25), max_angle=0.5, rng=np.random):
+    """
+    Draws a random board pose whose center projects inside the central part of the image.
+    """
+    width, height = size
+    rvec = rng.uniform(-max_angle, max_angle, 3) * np.array([1, 1, 0.5])
+    z = rng.uniform(*distance_range)
+    u = rng.uniform(0.3, 0.7) * width
+    v = rng.uniform(0.3, 0.7) * height
+    center = z * np.linalg.inv(K) @ np.array([u, v, 1.0])
+
+    # Put the board center (not its first corner) on the chosen ray
+    R, _ = cv.Rodrigues(rvec)
+    tvec = center - R @ np.array([(rows - 1) / 2, (columns - 1) / 2, 0.0])
+    return rvec, tvec
+
+def default_rig(size):
+    """
+    Returns a synthetic stereo rig for images of the given (width, height): both cameras share the intrinsics,
+    the second camera is 10 squares to the right of the first and turned slightly towards it.
+
+    Returns:
+        rig (dict): K1, dist1, K2, dist2, R, T (second camera pose relative to the first) and image_size.
+    """
+    width, height = size
+    K = np.array([[0.8 * width, 0, width / 2 + 0.01 * width], [0, 0.8 * width, height / 2 - 0.01 * height], [0, 0, 1]])
+    R, _ = cv.Rodrigues(np.array([0.0, -0.15, 0.01]))
+    return {
+        'K1': K, 'dist1': np.array([-0.12, 0.08, 0.0, 0.0, 0.0]),
+        'K2': K.copy(), 'dist2': np.array([-0.08, 0.05, 0.0, 0.0, 0.0]),
+        'R': R, 'T': np.array([[-10.0], [0.1], [0.5]]),
+        'image_size': (width, height),
+    }
+
+def board_in_view(K, dist, rvec, tvec, size, rows, columns, margin=0.05):
+    """
+    True if every corner of the board projects inside the image (with a margin) in front of the camera.
+    """
+    R, _ = cv.Rodrigues(np.asarray(rvec, np.float64))
+    depth = board_object_points(rows, columns) @ R.T + np.ravel(tvec)
+    if np.any(depth[:, 2] <= 0):
+        return False
+
+    corners, _ = cv.projectPoints(board_object_points(rows, columns), np.asarray(rvec, np.float64),
+                                  np.asarray(tvec, np.float64), K, dist)
+    corners = corners.reshape(-1, 2)
+    width, height = size
+    return bool(np.all((corners[:, 0] > margin * width) & (corners[:, 0] < (1 - margin) * width) &
+                       (corners[:, 1] > margin * height) & (corners[:, 1] < (1 - margin) * height)))
+
+def render_stereo_views(rig, frames, rows, columns, noise=0.0, rng=np.random, square_px=64):
+    """
+    Renders frame pairs of a checkerboard in random poses seen by both cameras of a rig.
+
+    Returns:
+        views (list): (image0, image1, corners0, corners1) for each pair, with grayscale images and
+            ground truth corners.
+    """
+    size = rig['image_size']
+    grids = (normalized_grid(rig['K1'], rig['dist1'], size), normalized_grid(rig['K2'], rig['dist2'], size))
+    texture = board_texture(rows, columns, square_px)
+
+    views = []
+    while len(views) < frames:
+        # Shift the board towards the second camera, so both cameras see it
+        rvec0, tvec0 = random_board_pose(rig['K1'], size, rows, columns, rng=rng)
+        tvec0 = tvec0 - np.ravel(rig['T']) / 2 * [1, 0, 0]
+        R0, _ = cv.Rodrigues(rvec0)
+        rvec1, _ = cv.Rodrigues(rig['R'] @ R0)
+        tvec1 = rig['R'] @ tvec0 + rig['T'].ravel()
+
+        if not (board_in_view(rig['K1'], rig['dist1'], rvec0, tvec0, size, rows, columns) and
+                board_in_view(rig['K2'], rig['dist2'], rvec1, tvec1, size, rows, columns)):
+            continue
+
+        image0, corners0 = render_board(rig['K1'], rig['dist1'], rvec0, tvec0, size, rows, columns, noise, grids[0], texture, square_px)
+        image1, corners1 = render_board(rig['K2'], rig['dist2'], rvec1, tvec1, size, rows, columns, noise, grids[1], texture, square_px)
+        views.append((image0, image1, corners0, corners1))
+    return views
+
+def random_scene_points(rig, count, rng=np.random):
+    """
+    Returns (count, 3) random points in the first camera frame that both cameras see.
+    """
+    size = rig['image_size']
+    points = []
+    while sum(len(p) for p in points) < count:
+        candidates = rng.uniform([-8, -6, 15], [8, 6, 35], (count, 3))
+        uv0, _ = cv.projectPoints(candidates, np.zeros(3), np.zeros(3), rig['K1'], rig['dist1'])
+        rvec, _ = cv.Rodrigues(rig['R'])
+        uv1, _ = cv.projectPoints(candidates, rvec, rig['T'], rig['K2'], rig['dist2'])
+        inside = np.ones(count, bool)
+        for uv, depth in ((uv0.reshape(-1, 2), candidates[:, 2]), (uv1.reshape(-1, 2), (candidates @ rig['R'].T + rig['T'].ravel())[:, 2])):
+            inside &= (uv[:, 0] >= 0) & (uv[:, 0] < size[0]) & (uv[:, 1] >= 0) & (uv[:, 1] < size[1]) & (depth > 0)
+        points.append(candidates[inside])
+    return np.concatenate(points)[:count]
+
+def project_rig_points(rig, points, noise=0.0, rng=np.random):
+    """
+    Projects 3D points (first camera frame) in both cameras of a rig, with optional gaussian pixel noise.
+
+    Returns:
+        uv0, uv1 (numpy.ndarray): (N,2) distorted pixel coordinates in both images.
+    """
+    uv0, _ = cv.projectPoints(points, np.zeros(3), np.zeros(3), rig['K1'], rig['dist1'])
+    rvec, _ = cv.Rodrigues(rig['R'])
+    uv1, _ = cv.projectPoints(points, rvec, rig['T'], rig['K2'], rig['dist2'])
+    uv0 = uv0.reshape(-1, 2) + rng.normal(0, noise, (len(points), 2))
+    uv1 = uv1.reshape(-1, 2) + rng.normal(0, noise, (len(points), 2))
+    return uv0, uv1
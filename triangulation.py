@@ -1,70 +1,212 @@
 import cv2 as cv
-import glob
 import numpy as np
-import matplotlib.pyplot as plt
 import os
+import time
+from collections import deque
+from rectification import undistort_points
+from reprojection import point_errors, point_residuals, refine_points
+import instrumentation
 
-def triangulate(mtx1, mtx2, R, T, points1, points2, foldername):
-    uvs1 = points1
-    uvs2 = points2
- 
-    uvs1 = np.array(uvs1)
-    uvs2 = np.array(uvs2)
+def projection_matrices(mtx1, mtx2, R, T):
+    """
+    Builds the projection matrices of both cameras.
 
-    frame1 = cv.imread(os.path.join(foldername, 'camera0_0.png'))
-    frame2 = cv.imread(os.path.join(foldername, 'camera1_0.png'))
- 
-    # Plot the points in the images
-    plt.imshow(frame1[:,:,[2,1,0]]) # BGR (opencv default) to RGB (matplotlib expected)
-    plt.scatter(uvs1[:,0], uvs1[:,1])
-    plt.show() #this call will cause a crash if you use cv.imshow() above. Comment out cv.imshow() to see this.
- 
-    plt.imshow(frame2[:,:,[2,1,0]])
-    plt.scatter(uvs2[:,0], uvs2[:,1])
-    plt.show()#this call will cause a crash if you use cv.imshow() above. Comment out cv.imshow() to see this
- 
+    Parameters:
+        mtx1, mtx2 (numpy.ndarray): Camera matrices of the first and second camera.
+        R (numpy.ndarray): Rotation matrix from stereo calibration.
+        T (numpy.ndarray): Translation vector from stereo calibration.
+
+    Returns:
+        P1, P2 (numpy.ndarray): 3x4 projection matrices. The first camera is the world origin.
+    """
     #RT matrix for C1 is identity.
     RT1 = np.concatenate([np.eye(3), [[0],[0],[0]]], axis = -1)
     P1 = mtx1 @ RT1 #projection matrix for C1
- 
+
     #RT matrix for C2 is the R and T obtained from stereo calibration.
-    RT2 = np.concatenate([R, T], axis = -1)
+    RT2 = np.concatenate([R, np.reshape(T, (3, 1))], axis = -1)
     P2 = mtx2 @ RT2 #projection matrix for C2
- 
-    # Implements linear triangulation using the Direct Linear Transform
-    def DLT(P1, P2, point1, point2):
- 
-        A = [point1[1]*P1[2,:] - P1[1,:],
-             P1[0,:] - point1[0]*P1[2,:],
-             point2[1]*P2[2,:] - P2[1,:],
-             P2[0,:] - point2[0]*P2[2,:]
-            ]
-        A = np.array(A).reshape((4,4))
- 
-        B = A.transpose() @ A
-        from scipy import linalg
-        U, s, Vh = linalg.svd(B, full_matrices = False)
- 
-        print('Triangulated point: ')
-        print(Vh[3,0:3]/Vh[3,3])
-        return Vh[3,0:3]/Vh[3,3]
- 
-    p3ds = [] # 3d points are gonna be stored in here
-    for uv1, uv2 in zip(uvs1, uvs2):
-        _p3d = DLT(P1, P2, uv1, uv2)
-        p3ds.append(_p3d)
-    p3ds = np.array(p3ds)
-    print(p3ds)
 
-    # Shift all points so the first point becomes the origin
-    origin = p3ds[0]
-    p3ds_shifted = p3ds - origin
+    return P1, P2
+
+@instrumentation.timed('triangulation.dlt_batch')
+def DLT_batch(P1, P2, uvs1, uvs2):
+    """
+    Linear triangulation (Direct Linear Transform) of N correspondences at once.
+
+    Parameters:
+        P1, P2 (numpy.ndarray): 3x4 projection matrices of both cameras.
+        uvs1, uvs2 (array-like): (N,2) pixel coordinates in the first and second image.
+
+    Returns:
+        p3ds (numpy.ndarray): (N,3) triangulated points.
+    """
+    uvs1 = np.asarray(uvs1, dtype=np.float64).reshape(-1, 2)
+    uvs2 = np.asarray(uvs2, dtype=np.float64).reshape(-1, 2)
+    if len(uvs1) != len(uvs2):
+        raise ValueError(f'DLT_batch needs the same number of points in both images, got {len(uvs1)} and {len(uvs2)}')
+
+    # Stack the N 4x4 systems: rows are v*P[2]-P[1] and P[0]-u*P[2] for each view
+    A = np.empty((uvs1.shape[0], 4, 4))
+    A[:, 0] = uvs1[:, 1, None] * P1[2] - P1[1]
+    A[:, 1] = P1[0] - uvs1[:, 0, None] * P1[2]
+    A[:, 2] = uvs2[:, 1, None] * P2[2] - P2[1]
+    A[:, 3] = P2[0] - uvs2[:, 0, None] * P2[2]
+
+    # The solution is the eigenvector of A^T A with the smallest eigenvalue
+    # (eigh sorts eigenvalues in ascending order)
+    B = np.transpose(A, (0, 2, 1)) @ A
+    _, V = np.linalg.eigh(B)
+    X = V[:, :, 0]
+
+    return X[:, 0:3] / X[:, 3:4]
+
+def rig_projection_matrices(mtxs, Rs, Ts):
+    """
+    Builds the projection matrices of every camera of a rig.
+
+    Parameters:
+        mtxs (list): Camera matrices.
+        Rs, Ts (list): Rotation and translation of every camera from the world frame (the first camera).
+
+    Returns:
+        Ps (numpy.ndarray): (C,3,4) projection matrices.
+    """
+    return np.array([mtx @ np.concatenate([R, np.reshape(T, (3, 1))], axis=-1) for mtx, R, T in zip(mtxs, Rs, Ts)])
+
+@instrumentation.timed('triangulation.dlt_multiview')
+def DLT_multiview(Ps, uvs):
+    """
+    Linear triangulation of N points seen by any subset of C cameras at once.
+
+    Parameters:
+        Ps (numpy.ndarray): (C,3,4) projection matrices.
+        uvs (array-like): (C,N,2) pixel coordinates, NaN where a point is not visible in a camera.
+
+    Returns:
+        p3ds (numpy.ndarray): (N,3) triangulated points, NaN for points seen by fewer than two cameras.
+    """
+    Ps = np.asarray(Ps, dtype=np.float64)
+    uvs = np.asarray(uvs, dtype=np.float64).reshape(len(Ps), -1, 2)
+    visible = ~np.isnan(uvs).any(axis=2)
+    u = np.where(visible, uvs[:, :, 0], 0)
+    v = np.where(visible, uvs[:, :, 1], 0)
+
+    # Two rows per (camera, point), zeroed where the point is not visible so they drop out of A^T A
+    A = np.empty(uvs.shape[:2] + (2, 4))
+    A[:, :, 0] = v[:, :, None] * Ps[:, None, 2] - Ps[:, None, 1]
+    A[:, :, 1] = Ps[:, None, 0] - u[:, :, None] * Ps[:, None, 2]
+    A *= visible[:, :, None, None]
+
+    # Sum of the per-camera A^T A blocks, then the eigenvector with the smallest eigenvalue as in DLT_batch
+    B = np.einsum('cnki,cnkj->nij', A, A)
+    _, V = np.linalg.eigh(B)
+    X = V[:, :, 0]
+
+    # Points without two views have a degenerate system (X[:, 3] may be 0), they are reported as NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p3ds = X[:, 0:3] / X[:, 3:4]
+    p3ds[visible.sum(axis=0) < 2] = np.nan
+    return p3ds
+
+def refine_triangulation(Ps, uvs, p3ds, refine=False):
+    """
+    Optionally refines linearly triangulated points and measures their reprojection error.
+
+    Returns:
+        p3ds (numpy.ndarray): (N,3) points (refined if 'refine' is set).
+        errors (numpy.ndarray): (N,) RMS reprojection error of each point, in (undistorted) pixels.
+    """
+    if refine:
+        return refine_points(Ps, uvs, p3ds)
+    return p3ds, point_errors(point_residuals(Ps, uvs, p3ds)[0])
+
+def triangulate_points(mtx1, mtx2, R, T, points1, points2, dist1=None, dist2=None, refine=False, return_errors=False):
+    """
+    Headless triangulation of corresponding points in both images.
+
+    Parameters:
+        mtx1, mtx2 (numpy.ndarray): Camera matrices of the first and second camera.
+        R, T (numpy.ndarray): Rotation and translation from stereo calibration.
+        points1, points2 (array-like): (N,2) pixel coordinates in the first and second image.
+        dist1, dist2 (numpy.ndarray): Distortion coefficients. When given, the points are undistorted first.
+        refine (bool): Refine the linear (DLT) points by minimizing their reprojection error in both images.
+        return_errors (bool): Also return the reprojection error of every point.
+
+    Returns:
+        p3ds (numpy.ndarray): (N,3) points in the first camera's coordinate system.
+        errors (numpy.ndarray): Only if 'return_errors' is set: (N,) RMS reprojection error of each point, in pixels.
+    """
+    with instrumentation.timer('triangulation.undistort'):
+        if dist1 is not None:
+            points1 = undistort_points(points1, mtx1, dist1)
+        if dist2 is not None:
+            points2 = undistort_points(points2, mtx2, dist2)
+
+    P1, P2 = projection_matrices(mtx1, mtx2, R, T)
+    p3ds = DLT_batch(P1, P2, points1, points2)
+    if not (refine or return_errors):
+        return p3ds
+
+    uvs = np.array([np.reshape(points1, (-1, 2)), np.reshape(points2, (-1, 2))], dtype=np.float64)
+    p3ds, errors = refine_triangulation(np.array([P1, P2]), uvs, p3ds, refine)
+    return (p3ds, errors) if return_errors else p3ds
+
+def triangulate_rig(mtxs, Rs, Ts, points, dists=None, refine=False, return_errors=False):
+    """
+    Headless triangulation of points clicked or detected in any subset of the cameras of a rig.
+
+    Parameters:
+        mtxs (list): Camera matrices.
+        Rs, Ts (list): Rotation and translation of every camera from the world frame (see calibration.calibrate_rig).
+        points (array-like): (C,N,2) pixel coordinates, NaN where a point is not visible in a camera.
+        dists (list): Distortion coefficients. When given, the points are undistorted first.
+        refine (bool): Refine the linear points by minimizing their reprojection error in every camera that saw them.
+        return_errors (bool): Also return the reprojection error of every point.
+
+    Returns:
+        p3ds (numpy.ndarray): (N,3) points in the first camera's coordinate system (NaN if seen by fewer than two cameras).
+        errors (numpy.ndarray): Only if 'return_errors' is set: (N,) RMS reprojection error of each point, in pixels.
+    """
+    points = np.array(points, dtype=np.float64).reshape(len(mtxs), -1, 2)
+    if dists is not None:
+        with instrumentation.timer('triangulation.undistort'):
+            for camera, (mtx, dist) in enumerate(zip(mtxs, dists)):
+                visible = ~np.isnan(points[camera]).any(axis=1)
+                points[camera, visible] = undistort_points(points[camera, visible], mtx, dist)
+
+    Ps = rig_projection_matrices(mtxs, Rs, Ts)
+    p3ds = DLT_multiview(Ps, points)
+    if not (refine or return_errors):
+        return p3ds
 
-    print("Shifted 3D points (first point is now origin):")
-    print(p3ds_shifted)
+    p3ds, errors = refine_triangulation(Ps, points, p3ds, refine)
+    return (p3ds, errors) if return_errors else p3ds
 
+def plot_triangulation(uvs1, uvs2, p3ds_shifted, foldername):
+    """
+    Shows the selected points on both images and the triangulated points in 3D.
+
+    Parameters:
+        uvs1, uvs2 (numpy.ndarray): (N,2) pixel coordinates in the first and second image.
+        p3ds_shifted (numpy.ndarray): (N,3) triangulated points, shifted to the chosen origin.
+        foldername (str): Folder containing 'camera0_0.png' and 'camera1_0.png'.
+    """
+    import matplotlib.pyplot as plt
     from mpl_toolkits.mplot3d import Axes3D
 
+    frame1 = cv.imread(os.path.join(foldername, 'camera0_0.png'))
+    frame2 = cv.imread(os.path.join(foldername, 'camera1_0.png'))
+
+    # Plot the points in the images
+    plt.imshow(frame1[:,:,[2,1,0]]) # BGR (opencv default) to RGB (matplotlib expected)
+    plt.scatter(uvs1[:,0], uvs1[:,1])
+    plt.show() #this call will cause a crash if you use cv.imshow() above. Comment out cv.imshow() to see this.
+
+    plt.imshow(frame2[:,:,[2,1,0]])
+    plt.scatter(uvs2[:,0], uvs2[:,1])
+    plt.show()#this call will cause a crash if you use cv.imshow() above. Comment out cv.imshow() to see this
+
     # Plot shifted points
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
@@ -90,4 +232,157 @@ def triangulate(mtx1, mtx2, R, T, points1, points2, foldername):
 
     plt.show()
 
-    return p3ds_shifted
\ No newline at end of file
+def triangulate(mtx1, mtx2, R, T, points1, points2, foldername, show=True, dist1=None, dist2=None, refine=False,
+                outlier_pixels=None, shift_origin=True):
+    # Points are paired in selection order, extra points selected in only one image are ignored
+    count = min(len(points1), len(points2))
+    if count == 0:
+        print("No points to triangulate.")
+        return np.empty((0, 3))
+    uvs1 = np.array(points1, dtype=np.float64).reshape(-1, 2)[:count]
+    uvs2 = np.array(points2, dtype=np.float64).reshape(-1, 2)[:count]
+
+    p3ds, errors = triangulate_points(mtx1, mtx2, R, T, uvs1, uvs2, dist1, dist2, refine, return_errors=True)
+    print(p3ds)
+
+    # Reprojection error of every point, the points above outlier_pixels are probably mismatched
+    print("Reprojection error of each point (pixels):")
+    print(errors)
+    if outlier_pixels is not None and np.any(errors > outlier_pixels):
+        print(f"Points above {outlier_pixels} pixels (check the selection):", np.flatnonzero(errors > outlier_pixels))
+
+    # Shift all points so the first point becomes the origin
+    # (only for hand-picked points: the first automatically matched feature is an arbitrary point of the scene)
+    if shift_origin:
+        origin = p3ds[0]
+        p3ds_shifted = p3ds - origin
+
+        print("Shifted 3D points (first point is now origin):")
+        print(p3ds_shifted)
+    else:
+        p3ds_shifted = p3ds
+
+    if show:
+        plot_triangulation(uvs1, uvs2, p3ds_shifted, foldername)
+
+    return p3ds_shifted
+
+
+def locate_color_markers(frame, colors, min_area=20):
+    """
+    Finds colored markers in a BGR frame: the centroid of the largest blob of each color.
+
+    Parameters:
+        frame (numpy.ndarray): BGR frame.
+        colors (dict): Marker name -> (lower, upper) HSV bounds, e.g. {'red': ((0, 120, 80), (10, 255, 255))}.
+        min_area (int): Smallest blob (in pixels) accepted as a marker.
+
+    Returns:
+        markers (dict): Marker name -> (x, y) pixel coordinates, for the markers found.
+    """
+    hsv = cv.cvtColor(frame, cv.COLOR_BGR2HSV)
+    markers = {}
+    for name, (lower, upper) in colors.items():
+        mask = cv.inRange(hsv, np.array(lower), np.array(upper))
+        count, _, stats, centroids = cv.connectedComponentsWithStats(mask)
+        if count <= 1:
+            continue
+
+        # Label 0 is the background
+        largest = 1 + int(np.argmax(stats[1:, cv.CC_STAT_AREA]))
+        if stats[largest, cv.CC_STAT_AREA] >= min_area:
+            markers[name] = tuple(centroids[largest])
+    return markers
+
+def aruco_locator(dictionary=None):
+    """
+    Returns a marker locator for ArUco markers: frame -> {marker id: (x, y) center}.
+    """
+    if dictionary is None:
+        dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_50)
+    detector = cv.aruco.ArucoDetector(dictionary, cv.aruco.DetectorParameters())
+
+    def locate(frame):
+        corners, ids, _ = detector.detectMarkers(frame)
+        if ids is None:
+            return {}
+        return {int(i): tuple(c.reshape(-1, 2).mean(axis=0)) for i, c in zip(ids.ravel(), corners)}
+    return locate
+
+class LatencyStats:
+    """
+    Rolling per-frame latency and frame rate statistics over the last 'window' frames.
+    """
+
+    def __init__(self, window=120):
+        self.latencies = deque(maxlen=window)
+        self.times = deque(maxlen=window)
+
+    def add(self, latency):
+        self.latencies.append(latency)
+        self.times.append(time.perf_counter())
+
+    def summary(self):
+        if not self.latencies:
+            return {'fps': 0.0, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+        latencies = np.array(self.latencies) * 1000
+        elapsed = self.times[-1] - self.times[0]
+        return {
+            'fps': (len(self.times) - 1) / elapsed if elapsed > 0 else 0.0,
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'max_ms': float(latencies.max()),
+        }
+
+def stream_triangulation(capture, mtx1, mtx2, R, T, locate, callback=None, max_frames=None, dist1=None, dist2=None):
+    """
+    Triangulates markers on every synchronized pair of a camera stream.
+
+    The projection matrices are computed once. For each pair, 'locate' finds the markers in both frames and
+    the markers seen by both cameras are triangulated in one batch.
+
+    Parameters:
+        capture: Pair source with a read() -> (ret, frame0, frame1, skew) method, e.g. both_webcams.StereoCapture.
+        mtx1, mtx2, R, T (numpy.ndarray): Stereo calibration.
+        locate (callable): frame -> {marker key: (x, y)}, e.g. aruco_locator() or a wrapped locate_color_markers.
+        callback (callable): Called with (keys, p3ds, stats) for every pair, if given.
+        max_frames (int): Stops after this number of pairs (None runs until the stream ends).
+        dist1, dist2 (numpy.ndarray): Distortion coefficients. When given, the marker positions are undistorted.
+
+    Yields:
+        keys (list): Marker keys seen by both cameras.
+        p3ds (numpy.ndarray): (N,3) triangulated points, in the order of keys.
+        stats (LatencyStats): Per-frame latency (from the pair being available to the 3D points) and frame rate.
+    """
+    P1, P2 = projection_matrices(mtx1, mtx2, R, T)
+    stats = LatencyStats()
+    frame_count = 0
+
+    while max_frames is None or frame_count < max_frames:
+        ret, frame0, frame1, skew = capture.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+
+        with instrumentation.timer('stream.locate'):
+            markers0 = locate(frame0)
+            markers1 = locate(frame1)
+        keys = [key for key in markers0 if key in markers1]
+        if keys:
+            uvs0 = np.array([markers0[key] for key in keys])
+            uvs1 = np.array([markers1[key] for key in keys])
+            if dist1 is not None:
+                uvs0 = undistort_points(uvs0, mtx1, dist1)
+            if dist2 is not None:
+                uvs1 = undistort_points(uvs1, mtx2, dist2)
+            p3ds = DLT_batch(P1, P2, uvs0, uvs1)
+        else:
+            p3ds = np.empty((0, 3))
+
+        stats.add(time.perf_counter() - start)
+        instrumentation.count('stream.frames')
+        frame_count += 1
+        if callback is not None:
+            callback(keys, p3ds, stats)
+        yield keys, p3ds, stats